@@ -40,10 +40,13 @@ setup(
         "uvicorn",
         "waitress",
         "pydantic",
-        "requests",
+        "httpx",
         "pyperclip",
         "pyyaml",
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     entry_points={
         "console_scripts": [
             "uniclip=uniclip.main:main",
@@ -2,26 +2,41 @@
 
 -- Configuration
 local config_path = vim.fn.expand('~/.config/uniclip/config.yaml')
-local poll_interval = 500 -- milliseconds
+local poll_interval = 500 -- minimum milliseconds between the starts of two polls
+local poll_wait = 30 -- seconds the server may hold a long-poll open
 local max_backoff = 64000 -- maximum backoff time in milliseconds
 local log_file = vim.fn.expand('/tmp/uniclip_log.txt')
 local max_log_size = 1000000 -- 1MB
+local compression_threshold = 4096 -- gzip update bodies at least this large
 
 local M = {}
 
+local uv = vim.loop
+
 -- Utility functions
 
+-- Parsed configuration, re-read only when config.yaml changes
+local config_cache = { mtime = nil, group_id = nil, server_address = nil }
+
 -- Load configuration from file
 local function load_config()
-  local f = io.open(config_path, "r")
-  if f then
+  local stat = uv.fs_stat(config_path)
+  if not stat then
+    error("Failed to load Uniclip configuration")
+  end
+  local mtime = stat.mtime.sec .. "." .. stat.mtime.nsec .. ":" .. stat.size
+  if config_cache.mtime ~= mtime then
+    local f = io.open(config_path, "r")
+    if not f then
+      error("Failed to load Uniclip configuration")
+    end
     local content = f:read("*all")
     f:close()
-    local group_id = content:match("group_id:%s*(.-)%s*\n")
-    local server_address = content:match("server_address:%s*(.-)%s*\n")
-    return group_id, server_address
+    config_cache.group_id = content:match("group_id:%s*(.-)%s*\n")
+    config_cache.server_address = content:match("server_address:%s*(.-)%s*\n")
+    config_cache.mtime = mtime
   end
-  error("Failed to load Uniclip configuration")
+  return config_cache.group_id, config_cache.server_address
 end
 
 -- Log error messages
@@ -30,7 +45,7 @@ local function log_error(message)
   if f then
     f:write(os.date("%Y-%m-%d %H:%M:%S") .. " - " .. message .. "\n")
     f:close()
-    
+
     -- Check file size and truncate if necessary
     local size = vim.fn.getfsize(log_file)
     if size > max_log_size then
@@ -40,18 +55,116 @@ local function log_error(message)
   end
 end
 
--- Make HTTP request
-local function make_request(method, url, body)
-  local curl_command = string.format(
-    "curl -s -X %s -H 'Content-Type: application/json' %s '%s'",
-    method,
-    body and string.format("-d '%s'", vim.fn.shellescape(body)) or "",
-    url
-  )
-  local handle = io.popen(curl_command)
-  local result = handle:read("*a")
-  handle:close()
-  return result
+-- Run cmd (a list, no shell) in the background, feeding it input on stdin.
+-- on_exit(code, stdout, stderr) is called on the main loop once it has finished.
+local function spawn(cmd, input, on_exit)
+  on_exit = vim.schedule_wrap(on_exit)
+  if vim.system then
+    local ok, err = pcall(vim.system, cmd, { stdin = input or false }, function(result)
+      on_exit(result.code, result.stdout or "", result.stderr or "")
+    end)
+    if not ok then
+      on_exit(-1, "", tostring(err))
+    end
+    return
+  end
+  -- Neovim < 0.10: plain libuv process with pipes
+  local stdin = uv.new_pipe(false)
+  local stdout = uv.new_pipe(false)
+  local stderr = uv.new_pipe(false)
+  local out, err = {}, {}
+  local pending = 3 -- process exit and EOF on both output pipes
+  local exit_code
+  local function done()
+    pending = pending - 1
+    if pending == 0 then
+      on_exit(exit_code, table.concat(out), table.concat(err))
+    end
+  end
+  local handle, spawn_error
+  handle, spawn_error = uv.spawn(cmd[1], { args = vim.list_slice(cmd, 2), stdio = { stdin, stdout, stderr } },
+    function(code)
+      exit_code = code
+      handle:close()
+      done()
+    end)
+  if not handle then
+    for _, pipe in ipairs({ stdin, stdout, stderr }) do
+      pipe:close()
+    end
+    on_exit(-1, "", tostring(spawn_error))
+    return
+  end
+  local function reader(pipe, chunks)
+    return function(read_error, data)
+      if data then
+        table.insert(chunks, data)
+      else
+        if read_error then
+          table.insert(err, read_error)
+        end
+        pipe:close()
+        done()
+      end
+    end
+  end
+  stdout:read_start(reader(stdout, out))
+  stderr:read_start(reader(stderr, err))
+  if input then
+    stdin:write(input)
+  end
+  stdin:shutdown(function()
+    stdin:close()
+  end)
+end
+
+-- Make an HTTP request with curl in the background.
+-- on_done(status, body, retry_after) gets the HTTP status (nil if the request failed), the response
+-- body, and the seconds of the Retry-After header the server sends when it is shedding load.
+local function make_request(method, url, opts, on_done)
+  opts = opts or {}
+  local cmd = { "curl", "-s", "--compressed", "-X", method, "-D", "-", "-w", "\n%{http_code}",
+                "--max-time", tostring(opts.timeout or 30) }
+  for _, header in ipairs(opts.headers or {}) do
+    vim.list_extend(cmd, { "-H", header })
+  end
+  if opts.body then
+    vim.list_extend(cmd, { "--data-binary", "@-" })
+  end
+  table.insert(cmd, url)
+  spawn(cmd, opts.body, function(code, stdout, stderr)
+    -- -D - writes the headers of every response (100 Continue included) before the body
+    local headers = ""
+    while stdout:sub(1, 5) == "HTTP/" do
+      local header_end = stdout:find("\r\n\r\n", 1, true)
+      if not header_end then
+        break
+      end
+      headers = stdout:sub(1, header_end + 1)
+      stdout = stdout:sub(header_end + 4)
+    end
+    local body, status = stdout:match("^(.*)\n(%d%d%d)$")
+    if code ~= 0 or not status or status == "000" then
+      on_done(nil, stderr ~= "" and stderr or ("curl exited with code " .. tostring(code)))
+      return
+    end
+    on_done(tonumber(status), body, tonumber(headers:lower():match("\nretry%-after:%s*(%d+)")))
+  end)
+end
+
+-- Compress body with gzip in the background if it is large enough; on_done(body, encoding or nil)
+local function maybe_compress(body, on_done)
+  if #body < compression_threshold or vim.fn.executable("gzip") ~= 1 then
+    on_done(body, nil)
+    return
+  end
+  spawn({ "gzip", "-c" }, body, function(code, compressed)
+    if code == 0 and #compressed > 0 then
+      on_done(compressed, "gzip")
+    else
+      on_done(body, nil)
+    end
+  end)
 end
 
 -- Hash content
@@ -64,89 +177,184 @@ local function get_timestamp()
   return os.time()
 end
 
--- Send content to server
-function M.send_to_server(content, timestamp)
+local send_generation = 0 -- bumped by every send, so a deferred retry never resends an older yank
+
+-- Send content to server; on_sent(seq), if given, gets the number the server gave the message.
+-- attempt counts retries after the server refused the update as too busy.
+function M.send_to_server(content, timestamp, on_sent, attempt)
+  attempt = attempt or 0
+  send_generation = send_generation + 1
+  local generation = send_generation
   local group_id, server_address = load_config()
-  local temp_file = os.tmpname()
-  
-  local f = io.open(temp_file, "w")
-  if not f then
-    log_error("Failed to create temporary file")
-    return
-  end
-  f:write(vim.fn.json_encode({
+  local body = vim.fn.json_encode({
     group_id = group_id,
     client_id = "neovim-client",
     content = content,
     timestamp = timestamp
-  }))
-  f:close()
-
-  local curl_command = string.format(
-    "curl -s -X POST -H 'Content-Type: application/json' -d '@%s' '%s/update'",
-    temp_file,
-    server_address
-  )
-
-  local handle = io.popen(curl_command .. " 2>&1")
-  local result = handle:read("*a")
-  local success, exit_type, exit_code = handle:close()
-  
-  os.remove(temp_file)
-
-  if not success then
-    log_error("Failed to send update to server. Exit type: " .. tostring(exit_type) .. ", Exit code: " .. tostring(exit_code))
-    log_error("Command output: " .. result)
-  elseif not result:match('"status":"updated"') then
-    log_error("Server response doesn't indicate success. Response: " .. result)
-  end
+  })
+  maybe_compress(body, function(request_body, encoding)
+    local headers = { "Content-Type: application/json" }
+    if encoding then
+      table.insert(headers, "Content-Encoding: " .. encoding)
+    end
+    make_request("POST", server_address .. "/update", { body = request_body, headers = headers }, function(status, result, retry_after)
+      if not status then
+        log_error("Failed to send update to server: " .. result)
+      elseif status == 429 or status == 503 then
+        -- Wait as long as the server asks, or back off exponentially if it doesn't say
+        local delay = retry_after or math.min(2 ^ attempt, max_backoff / 1000)
+        log_error("Server is busy (status " .. status .. "), retrying the update in " .. delay .. " seconds")
+        vim.defer_fn(function()
+          if generation == send_generation then
+            M.send_to_server(content, timestamp, on_sent, attempt + 1)
+          end
+        end, delay * 1000)
+      elseif status ~= 200 or not result:match('"status":%s*"updated"') then
+        log_error("Server response doesn't indicate success. Status: " .. status .. ", response: " .. result)
+      elseif on_sent then
+        on_sent(tonumber(result:match('"seq":%s*(%d+)')))
+      end
+    end)
+  end)
 end
 
--- Receive content from server
-function M.receive_from_server(content_hash, timestamp)
+-- Receive content from server; on_done(data) gets the decoded response, or nil and the
+-- server's Retry-After in seconds (if any) on failure.
+-- wait > 0 long-polls: the server answers as soon as the group changes, or after wait seconds.
+-- since is the seq of the last message seen, nil to compare timestamps instead.
+function M.receive_from_server(content_hash, timestamp, since, wait, on_done)
   local group_id, server_address = load_config()
-  local url = string.format("%s/poll/%s/neovim-client?hash=%s&timestamp=%d", server_address, group_id, content_hash, timestamp)
-  local response = make_request("GET", url)
-  local success, data = pcall(vim.fn.json_decode, response)
-  if not success then
-    log_error("Failed to decode server response: " .. response)
-    return nil
+  local url = string.format("%s/poll/%s/neovim-client?hash=%s&timestamp=%d&wait=%d",
+                            server_address, group_id, content_hash, timestamp, wait)
+  if since then
+    url = url .. "&since=" .. since
   end
-  return data
+  make_request("GET", url, { timeout = wait + 15 }, function(status, response, retry_after)
+    if status ~= 200 then
+      log_error("Poll failed. Status: " .. tostring(status) .. ", response: " .. response)
+      on_done(nil, retry_after)
+      return
+    end
+    local success, data = pcall(vim.fn.json_decode, response)
+    if not success then
+      log_error("Failed to decode server response: " .. response)
+      on_done(nil)
+      return
+    end
+    on_done(data)
+  end)
 end
 
 -- Clipboard sync functions
 
 local last_clipboard = ""
 local last_timestamp = 0
+local last_seq = nil -- seq of the last group message seen, the poll cursor
+local last_hash = hash_content(last_clipboard) -- cached so polls don't rehash the register
 local current_backoff = poll_interval
+local polling = false
+
+-- Remember the current clipboard content and its hash
+local function set_last_clipboard(content, timestamp, content_hash)
+  last_clipboard = content
+  last_timestamp = timestamp
+  last_hash = content_hash or hash_content(content)
+end
+
+-- Move the poll cursor forward to seq, which is nil from servers that don't number messages
+local function advance_seq(seq)
+  if type(seq) == "number" and (last_seq == nil or seq > last_seq) then
+    last_seq = seq
+  end
+end
 
--- Update clipboard with exponential backoff
-local function update_clipboard()
-  local content_hash = hash_content(last_clipboard)
-  local data = M.receive_from_server(content_hash, last_timestamp)
-  if data then
-    if data.status == "update_needed" then
-      if data.content ~= last_clipboard then
-        vim.fn.setreg('"', data.content)
-        last_clipboard = data.content
-        last_timestamp = data.timestamp
+-- Put content received from the server into the unnamed register
+local function receive_content(content, timestamp, content_hash)
+  if content ~= last_clipboard then
+    vim.fn.setreg('"', content)
+  end
+  set_last_clipboard(content, timestamp, content_hash)
+end
+
+-- Fetch an uploaded text content from /blobs (see the server's chunked uploads)
+local function fetch_blob(data, on_done)
+  local group_id, server_address = load_config()
+  make_request("GET", string.format("%s/blobs/%s/%s", server_address, group_id, data.hash), { timeout = 300 },
+    function(status, body)
+      if status ~= 200 then
+        log_error("Failed to download content from server. Status: " .. tostring(status))
+        on_done(false)
+        return
+      end
+      if data.timestamp > last_timestamp then
+        receive_content(body, data.timestamp, data.hash)
       end
+      advance_seq(data.seq)
+      on_done(true)
+    end)
+end
+
+-- Apply a poll response; on_done(ok) is called once it has been applied
+local function apply_poll_response(data, on_done)
+  if data.status == "update_needed" and data.mime_type then
+    if data.hash == last_hash or not vim.startswith(data.mime_type, "text/") then
+      -- Our own upload, or a file the register cannot hold
+      last_timestamp = math.max(last_timestamp, data.timestamp or 0)
+      advance_seq(data.seq)
+      on_done(true)
+      return
     end
-    current_backoff = poll_interval -- Reset backoff on successful poll
-  else
-    log_error("Failed to receive update from server. Retrying in " .. current_backoff / 1000 .. " seconds.")
-    current_backoff = math.min(current_backoff * 2, max_backoff) -- Exponential backoff
+    fetch_blob(data, on_done)
+    return
+  elseif data.status == "update_needed" then
+    receive_content(data.content, data.timestamp, data.hash)
+  elseif data.status == "not_modified" then
+    last_timestamp = math.max(last_timestamp, data.timestamp or 0)
+  end
+  advance_seq(data.seq)
+  on_done(true)
+end
+
+-- Long-poll in the background, one request at a time, with exponential backoff on errors
+local function poll_loop()
+  local started = uv.now()
+  local function schedule_next(ok, retry_after)
+    local delay
+    if ok then
+      current_backoff = poll_interval -- Reset backoff on successful poll
+      -- Servers that cannot hold polls answer at once; don't ask more often than poll_interval
+      delay = math.max(0, poll_interval - (uv.now() - started))
+    else
+      -- A busy server says how long to stay away (Retry-After)
+      delay = math.max(current_backoff, (retry_after or 0) * 1000)
+      log_error("Failed to receive update from server. Retrying in " .. delay / 1000 .. " seconds.")
+      -- The server may come back numbering messages from scratch, go by timestamp until it sends a seq
+      last_seq = nil
+      current_backoff = math.min(current_backoff * 2, max_backoff) -- Exponential backoff
+    end
+    vim.defer_fn(poll_loop, delay)
+  end
+  local ok, err = pcall(M.receive_from_server, last_hash, last_timestamp, last_seq, poll_wait, function(data, retry_after)
+    if data then
+      apply_poll_response(data, schedule_next)
+    else
+      schedule_next(false, retry_after)
+    end
+  end)
+  if not ok then
+    -- e.g. a missing or unreadable config file
+    log_error(tostring(err))
+    schedule_next(false)
   end
 end
 
 -- Start background polling
 local function start_background_poll()
-  local timer = vim.loop.new_timer()
-  timer:start(0, current_backoff, vim.schedule_wrap(function()
-    update_clipboard()
-    timer:set_repeat(current_backoff) -- Update the timer interval
-  end))
+  if polling then
+    return
+  end
+  polling = true
+  poll_loop()
 end
 
 -- Setup function
@@ -158,22 +366,13 @@ function M.setup()
     callback = function()
       local yanked_text = table.concat(vim.v.event.regcontents, "\n")
       local timestamp = get_timestamp()
-      M.send_to_server(yanked_text, timestamp)
-      last_clipboard = yanked_text
-      last_timestamp = timestamp
+      set_last_clipboard(yanked_text, timestamp)
+      M.send_to_server(yanked_text, timestamp, advance_seq)
     end,
   })
 
-  vim.keymap.set('n', 'p', function()
-    local content_hash = hash_content(last_clipboard)
-    local data = M.receive_from_server(content_hash, last_timestamp)
-    if data and data.status == "update_needed" and data.content ~= last_clipboard then
-      vim.fn.setreg('"', data.content)
-      last_clipboard = data.content
-      last_timestamp = data.timestamp
-    end
-    return 'p'
-  end, { expr = true })
+  -- p needs no mapping: the background poll puts what it receives in the unnamed
+  -- register right away, so pasting never waits for the network
 
   start_background_poll()
 end
@@ -181,26 +380,27 @@ end
 -- Function to check Uniclip status
 function M.check_status()
   local group_id, server_address = load_config()
-  local content_hash = hash_content(last_clipboard)
-  local response = make_request("GET", string.format("%s/poll/%s/neovim-client?hash=%s&timestamp=%d", server_address, group_id, content_hash, last_timestamp))
-  local success, data = pcall(vim.fn.json_decode, response)
-  if success and data then
-    print("Uniclip server is running and reachable.")
+  local content_hash = last_hash
+  local function print_state()
     print("Server address: " .. server_address)
     print("Group ID: " .. group_id)
     print("Current backoff: " .. current_backoff / 1000 .. " seconds")
     print("Last clipboard content hash: " .. content_hash)
     print("Last clipboard timestamp: " .. os.date("%Y-%m-%d %H:%M:%S", last_timestamp))
-    print("Server response: " .. vim.inspect(data))
-  else
-    print("Unable to reach Uniclip server or server is not responding correctly.")
-    print("Server address: " .. server_address)
-    print("Group ID: " .. group_id)
-    print("Current backoff: " .. current_backoff / 1000 .. " seconds")
-    print("Last clipboard content hash: " .. content_hash)
-    print("Last clipboard timestamp: " .. os.date("%Y-%m-%d %H:%M:%S", last_timestamp))
-    print("Server response: " .. vim.inspect(response))
   end
+  local url = string.format("%s/poll/%s/neovim-client?hash=%s&timestamp=%d", server_address, group_id, content_hash, last_timestamp)
+  make_request("GET", url, { timeout = 10 }, function(status, response)
+    local success, data = pcall(vim.fn.json_decode, response)
+    if status == 200 and success and data then
+      print("Uniclip server is running and reachable.")
+      print_state()
+      print("Server response: " .. vim.inspect(data))
+    else
+      print("Unable to reach Uniclip server or server is not responding correctly.")
+      print_state()
+      print("Server response: " .. vim.inspect(response))
+    end
+  end)
 end
 
 -- Function to display log
@@ -240,4 +440,4 @@ end, {
   end,
 })
 
-return M
\ No newline at end of file
+return M
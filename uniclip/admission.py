@@ -0,0 +1,95 @@
+import math
+import time
+from .compression import DecompressionMiddleware
+
+def retry_after(seconds):
+    # Retry-After takes whole seconds; rounding up keeps clients from coming back too early
+    return str(max(1, math.ceil(seconds)))
+
+class RateLimiter:
+    """Token buckets, one per key (a client or a group).
+
+    A key may send `burst` requests at once and `rate` per second after
+    that. Buckets that have refilled completely are forgotten, so memory
+    only grows with the number of recently active keys. Each server process
+    keeps its own buckets: with several workers a key can get up to
+    `workers` times the rate.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # key -> (tokens, when tokens was last computed)
+        self.buckets = {}
+        self.next_sweep = 0
+
+    def acquire(self, key, now=None):
+        # Takes a token; returns 0 if one was available, otherwise the seconds until there will be one
+        now = time.monotonic() if now is None else now
+        self.sweep(now)
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0
+
+    def sweep(self, now):
+        # A bucket untouched for burst / rate seconds is full again, the same as no bucket
+        if now < self.next_sweep:
+            return
+        refill = self.burst / self.rate
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < refill}
+        self.next_sweep = now + refill
+
+class BodyLimitMiddleware:
+    """ASGI middleware refusing request bodies larger than max_size bytes with 413.
+
+    Bodies that announce a larger Content-Length are refused before any of
+    it is read, others are counted as they arrive. Requests matching one of
+    the `unlimited` (method, path prefix) pairs are passed through; upload
+    chunks are streamed to disk and limited by the upload size instead.
+    """
+
+    def __init__(self, app, max_size, unlimited=()):
+        self.app = app
+        self.max_size = max_size
+        self.unlimited = tuple(unlimited)
+
+    def is_unlimited(self, scope):
+        return any(scope['method'] == method and scope['path'].startswith(prefix) for method, prefix in self.unlimited)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or self.max_size is None or self.is_unlimited(scope):
+            return await self.app(scope, receive, send)
+        detail = f"Request body is larger than {self.max_size} bytes"
+        length = dict(scope['headers']).get(b'content-length')
+        if length is not None and length.isdigit() and int(length) > self.max_size:
+            return await DecompressionMiddleware.reject(send, 413, detail)
+
+        received = 0
+        started = False
+        rejected = False
+
+        async def receive_limited():
+            nonlocal received, rejected
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_size and not started:
+                    # Answer for the app, which sees the client go away
+                    rejected = True
+                    await DecompressionMiddleware.reject(send, 413, detail)
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def send_unless_rejected(message):
+            nonlocal started
+            if rejected:
+                return
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        await self.app(scope, receive_limited, send_unless_rejected)
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+import httpx
+from .server import CONFIG_ENV, ServerConfig
+
+@dataclass
+class BenchConfig:
+    groups: int = 10
+    clients: int = 5
+    # Seconds of load after every client has registered
+    duration: float = 30
+    # Fraction of client operations that are /update, the rest are /poll
+    update_ratio: float = 0.1
+    # Payload sizes are lognormal: median bytes and sigma of the underlying normal
+    payload_median: int = 200
+    payload_sigma: float = 2.0
+    max_payload: int = 1048576
+    # Pause between a client's operations (0 runs every client flat out)
+    think_time: float = 0
+    # Local server settings; ignored when benchmarking an existing server
+    workers: int = 1
+    durability: str = 'group'
+    server: Optional[str] = None
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds):
+        self.samples.setdefault(endpoint, []).append(seconds * 1000)
+
+    def error(self, endpoint):
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    @staticmethod
+    def percentile(ordered, fraction):
+        # Nearest-rank percentile of an already sorted list
+        return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+    def summary(self, elapsed):
+        result = {}
+        for endpoint in sorted(set(self.samples) | set(self.errors)):
+            ordered = sorted(self.samples.get(endpoint, []))
+            stats = {"requests": len(ordered), "errors": self.errors.get(endpoint, 0),
+                     "throughput_rps": round(len(ordered) / elapsed, 1) if elapsed else 0}
+            if ordered:
+                stats.update({f"p{p}_ms": round(self.percentile(ordered, p / 100), 3) for p in (50, 95, 99)})
+                stats["max_ms"] = round(ordered[-1], 3)
+            result[endpoint] = stats
+        return result
+
+class Benchmark:
+    """Drives a uniclip server with simulated groups of clients and reports latencies as JSON.
+
+    Unless config.server points at a running server, a local one is started
+    in a subprocess with a temporary database, so the load generator does
+    not compete with it for the GIL.
+    """
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.recorder = LatencyRecorder()
+        self.rng = random.Random()
+        self.timestamp = int(time.time() * 1000)
+        self.payload_bytes = 0
+        self.workdir = None
+        self.process = None
+
+    def run(self):
+        try:
+            address = self.config.server or self.start_server()
+            return asyncio.run(self.measure(address))
+        finally:
+            self.stop_server()
+
+    def start_server(self):
+        self.workdir = tempfile.mkdtemp(prefix='uniclip-bench-')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        server_config = ServerConfig(host='127.0.0.1', port=port, workers=self.config.workers,
+                                     durability=self.config.durability,
+                                     db_name=os.path.join(self.workdir, 'uniclip.db'),
+                                     blob_dir=os.path.join(self.workdir, 'blobs'),
+                                     # Measure what the server can take, not its admission limits
+                                     client_rate=None, group_rate=None, write_queue_limit=None)
+        env = dict(os.environ, **{CONFIG_ENV: json.dumps(asdict(server_config))})
+        self.logger.info(f"Starting benchmark server on port {port} with {self.config.workers} worker(s) in {self.workdir}")
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'uniclip.server:create_worker_app', '--factory',
+             '--host', '127.0.0.1', '--port', str(port), '--workers', str(self.config.workers),
+             '--log-level', 'warning'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return f"http://127.0.0.1:{port}"
+
+    def stop_server(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+        if self.workdir is not None:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    def storage_bytes(self):
+        # Database, WAL and blob files of the local server
+        if self.workdir is None:
+            return None
+        total = 0
+        for root, _, files in os.walk(self.workdir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    async def wait_until_ready(self, http, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await http.get("/history/uniclip-bench")
+                return
+            except httpx.TransportError:
+                if self.process is not None and self.process.poll() is not None:
+                    raise RuntimeError("Benchmark server exited during startup")
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Benchmark server did not start in time")
+                await asyncio.sleep(0.2)
+
+    def payload(self):
+        size = int(self.rng.lognormvariate(math.log(self.config.payload_median), self.config.payload_sigma))
+        size = min(max(size, 1), self.config.max_payload)
+        self.payload_bytes += size
+        # Random hex compresses and diffs about as badly as real-world clipboard contents can
+        return os.urandom((size + 1) // 2).hex()[:size]
+
+    def next_timestamp(self):
+        self.timestamp += 1
+        return self.timestamp
+
+    async def timed(self, endpoint, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.recorder.error(endpoint)
+            return None
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            self.recorder.error(endpoint)
+            return None
+        self.recorder.record(endpoint, elapsed)
+        return response
+
+    async def measure(self, address):
+        total_clients = self.config.groups * self.config.clients
+        limits = httpx.Limits(max_connections=total_clients, max_keepalive_connections=total_clients)
+        async with httpx.AsyncClient(base_url=address, limits=limits, timeout=60) as http:
+            await self.wait_until_ready(http)
+            size_before = self.storage_bytes()
+            # Load starts once every client has registered
+            registered = asyncio.Semaphore(0)
+            started = asyncio.Event()
+            window = {}
+
+            async def client(group_id, client_id):
+                await self.timed("/register", http.post("/register", json={"group_id": group_id, "client_id": client_id}))
+                registered.release()
+                await started.wait()
+                await self.load(http, group_id, client_id, window['deadline'])
+
+            clients = [asyncio.ensure_future(client(f"bench-{g}", f"bench-{g}-{c}"))
+                       for g in range(self.config.groups) for c in range(self.config.clients)]
+            for _ in range(total_clients):
+                await registered.acquire()
+            self.logger.info(f"{total_clients} clients registered in {self.config.groups} groups, "
+                             f"running for {self.config.duration}s")
+            start = time.monotonic()
+            window['deadline'] = start + self.config.duration
+            started.set()
+            await asyncio.gather(*clients)
+            elapsed = time.monotonic() - start
+        size_after = self.storage_bytes()
+
+        endpoints = self.recorder.summary(elapsed)
+        updates = endpoints.get("/update", {}).get("requests", 0)
+        report = {
+            "config": asdict(self.config),
+            "elapsed_s": round(elapsed, 3),
+            "endpoints": endpoints,
+            "payload_bytes_sent": self.payload_bytes,
+        }
+        if size_before is not None:
+            report["storage"] = {"bytes_before": size_before, "bytes_after": size_after,
+                                 "growth_bytes": size_after - size_before,
+                                 "growth_bytes_per_update": round((size_after - size_before) / updates, 1) if updates else None}
+        return report
+
+    async def load(self, http, group_id, client_id, deadline):
+        last_timestamp, last_hash = 0, None
+        while time.monotonic() < deadline:
+            if self.rng.random() < self.config.update_ratio:
+                last_timestamp = self.next_timestamp()
+                await self.timed("/update", http.post("/update", json={
+                    "group_id": group_id, "client_id": client_id,
+                    "content": self.payload(), "timestamp": last_timestamp}))
+            else:
+                params = {"timestamp": last_timestamp}
+                if last_hash:
+                    params["hash"] = last_hash
+                response = await self.timed("/poll", http.get(f"/poll/{group_id}/{client_id}", params=params))
+                if response is not None:
+                    data = response.json()
+                    last_timestamp = data.get("timestamp", last_timestamp)
+                    last_hash = data.get("hash", last_hash)
+            if self.config.think_time:
+                await asyncio.sleep(self.config.think_time)
@@ -0,0 +1,152 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from .compression import COMPRESSION_THRESHOLD, available_encodings, compress, decompress, decompress_prefix
+
+# Only the start of very large contents goes into the search index
+FTS_MAX_BYTES = 65536
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def index_text(data):
+    # The text indexed for a blob; deleting it from the index needs exactly the same text
+    return bytes(data[:FTS_MAX_BYTES]).decode('utf-8', errors='ignore')
+
+class BlobStore:
+    """Content-addressed, reference-counted storage for message payloads.
+
+    Payloads live in the blobs table keyed by their SHA-256 digest, so a
+    payload copied many times is stored once. Payloads of at least
+    file_threshold bytes are written to files under blob_dir instead and read
+    back through mmap; a file_threshold of None keeps everything in SQLite.
+    Payloads of at least compress_threshold bytes are stored compressed when
+    that makes them smaller. When fts_enabled is set, each blob's text is also
+    kept in the blobs_fts full-text index. Files received through chunked
+    uploads are taken over with adopt(), without reading them into memory;
+    they are never compressed or indexed.
+    """
+
+    def __init__(self, blob_dir='uniclip-blobs', file_threshold=262144, compress_threshold=COMPRESSION_THRESHOLD):
+        self.blob_dir = blob_dir
+        self.file_threshold = file_threshold
+        self.compress_threshold = compress_threshold
+        self.fts_enabled = False
+
+    def add(self, conn, data, digest=None):
+        # Must run inside a transaction; returns the digest to store on the message
+        digest = digest or content_digest(data)
+        if conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,)).rowcount:
+            return digest
+        size = len(data)
+        raw = data
+        encoding = None
+        if self.compress_threshold is not None and size >= self.compress_threshold:
+            encoding = available_encodings()[0]
+            compressed = compress(data, encoding)
+            if len(compressed) < size:
+                data = compressed
+            else:
+                encoding = None
+        path = None
+        if self.file_threshold is not None and len(data) >= self.file_threshold:
+            path = self.write_file(digest, data)
+            data = None
+        cursor = conn.execute('''
+            INSERT INTO blobs (hash, size, refcount, data, path, encoding, indexed) VALUES (?, ?, 1, ?, ?, ?, ?)
+        ''', (digest, size, data, path, encoding, int(self.fts_enabled)))
+        if self.fts_enabled:
+            conn.execute('INSERT INTO blobs_fts (rowid, content) VALUES (?, ?)', (cursor.lastrowid, index_text(raw)))
+        return digest
+
+    def adopt(self, conn, source, digest, size):
+        # Must run inside a transaction. Moves the verified file at source into the store,
+        # or deletes it if the blob already exists; returns the digest to store on the message
+        if conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,)).rowcount:
+            os.remove(source)
+            return digest
+        path = os.path.join(digest[:2], digest)
+        full_path = self.full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(source, full_path)
+        conn.execute('''
+            INSERT INTO blobs (hash, size, refcount, data, path, encoding, indexed) VALUES (?, ?, 1, NULL, ?, NULL, 0)
+        ''', (digest, size, path))
+        return digest
+
+    def release(self, conn, digests):
+        # Must run inside a transaction. Drops one reference per digest and deletes blobs
+        # nobody refers to anymore; returns (bytes freed, files to remove once committed and rechecked)
+        conn.executemany('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', [(d,) for d in digests])
+        freed, paths = 0, []
+        for digest in set(digests):
+            orphan = conn.execute('''
+                SELECT rowid, size, data, path, encoding, indexed FROM blobs WHERE hash = ? AND refcount <= 0
+            ''', (digest,)).fetchone()
+            if not orphan:
+                continue
+            rowid, size, data, path, encoding, indexed = orphan
+            if indexed:
+                text = index_text(self.read_prefix(data, path, encoding, FTS_MAX_BYTES))
+                conn.execute("INSERT INTO blobs_fts (blobs_fts, rowid, content) VALUES ('delete', ?, ?)", (rowid, text))
+            conn.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+            freed += size
+            if path:
+                paths.append(path)
+        return freed, paths
+
+    def remove_files(self, paths):
+        # Only for files of blobs no row refers to, with the write lock held (see DatabaseManager)
+        for path in paths:
+            try:
+                os.remove(self.full_path(path))
+            except FileNotFoundError:
+                pass
+
+    def read(self, data, path, encoding=None):
+        # Takes the data, path and encoding columns of a blobs row
+        if path is not None:
+            with open(self.full_path(path), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    data = m[:] if encoding is None else decompress(m, encoding)
+            return data
+        if data is None:
+            return None
+        return bytes(data) if encoding is None else decompress(data, encoding)
+
+    def read_prefix(self, data, path, encoding, length):
+        # Like read, but only the first length bytes of the payload
+        if path is not None:
+            with open(self.full_path(path), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m[:length] if encoding is None else decompress_prefix(m, encoding, length)
+        if data is None:
+            return b''
+        return bytes(data[:length]) if encoding is None else decompress_prefix(data, encoding, length)
+
+    def iter_file(self, path, start, stop, chunk_size=1048576):
+        # Yields bytes start..stop-1 of an uncompressed blob file without loading all of it
+        with open(self.full_path(path), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def full_path(self, path):
+        return os.path.join(self.blob_dir, path)
+
+    def write_file(self, digest, data):
+        path = os.path.join(digest[:2], digest)
+        full_path = self.full_path(path)
+        if not os.path.exists(full_path):
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, full_path)
+        return path
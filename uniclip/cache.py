@@ -0,0 +1,94 @@
+from collections import OrderedDict, namedtuple
+
+# encoded maps a content encoding to the compressed update_needed response body, shared by all pollers.
+# Uploaded messages carry their mime_type and size instead of content, see uniclip.uploads.
+# seq is the message's number within its group, see MemoryState.next_seq
+CachedMessage = namedtuple('CachedMessage',
+                           ['content', 'timestamp', 'client_id', 'digest', 'encoded', 'mime_type', 'size', 'seq'],
+                           defaults=(None, None, None))
+
+# Marks a group that is known to have no messages, so repeated misses stay off the database
+EMPTY = object()
+
+def entry_size(entry):
+    # Characters of content held by an entry, its compressed bodies are added by charge()
+    return len(entry.content) if isinstance(entry, CachedMessage) and entry.content else 0
+
+class LatestMessageCache:
+    """Bounded LRU map of group_id -> latest CachedMessage.
+
+    Holds at most max_groups entries and about max_bytes of content and
+    compressed bodies; either limit is off when None. The most recently
+    stored entry is kept even if it alone is over max_bytes.
+    """
+
+    def __init__(self, max_groups=10000, max_bytes=None):
+        self.max_groups = max_groups
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # group_id -> bytes accounted to its entry, and their total
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, group_id):
+        # Returns a CachedMessage, EMPTY, or None when the group is not cached
+        entry = self.entries.get(group_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(group_id)
+        return entry
+
+    def put(self, group_id, entry):
+        self.entries[group_id] = entry
+        self.entries.move_to_end(group_id)
+        self.resize(group_id, entry_size(entry))
+        self.evict()
+
+    def resize(self, group_id, size):
+        self.bytes += size - self.sizes.get(group_id, 0)
+        self.sizes[group_id] = size
+
+    def evict(self):
+        while len(self.entries) > 1 and (
+                (self.max_groups is not None and len(self.entries) > self.max_groups)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            group_id, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(group_id, 0)
+
+    def charge(self, group_id, digest, size):
+        # Accounts a compressed body of size bytes stored in the encoded map of the group's entry
+        entry = self.entries.get(group_id)
+        if isinstance(entry, CachedMessage) and entry.digest == digest:
+            self.resize(group_id, self.sizes.get(group_id, 0) + size)
+            self.evict()
+
+    def peek(self, group_id):
+        # Like get, without touching LRU order or hit counters
+        return self.entries.get(group_id)
+
+    def fill(self, group_id, entry):
+        # Stores a database result unless a write landed while the query was in flight
+        current = self.entries.get(group_id)
+        if current is not None:
+            return current
+        self.put(group_id, entry)
+        return entry
+
+    def update(self, group_id, content, timestamp, client_id, digest, seq, mime_type=None, size=None):
+        # Write-through from handle_update; keeps the message with the highest seq like the database query
+        current = self.entries.get(group_id)
+        if isinstance(current, CachedMessage) and current.seq is not None and current.seq > seq:
+            self.entries.move_to_end(group_id)
+            return
+        self.put(group_id, CachedMessage(content, timestamp, client_id, digest, {}, mime_type, size, seq))
+
+    def invalidate(self, group_id):
+        self.entries.pop(group_id, None)
+        self.bytes -= self.sizes.pop(group_id, 0)
+
+    def __len__(self):
+        return len(self.entries)
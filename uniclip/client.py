@@ -1,25 +1,105 @@
-import threading
-import time
+import asyncio
+import codecs
+import email.utils
 import os
-import requests
+import random
+import signal
+import time
+import httpx
 import pyperclip
 import socket
 import uuid
 import hashlib
+import json
+from .compression import COMPRESSION_THRESHOLD, compress, negotiate, parse_accept_encoding
+from .delta import DELTA_THRESHOLD, apply_delta, make_delta, worth_sending
+from .metrics import ClientMetrics
+from .outbox import Outbox
+from .uploads import CHUNK_SIZE, TEXT_MIME_TYPE, UPLOAD_THRESHOLD, FileContent, file_digest, is_text, sniff_mime_type
+from .watchers import AdaptiveClipboardWatcher, PollingFileWatcher, create_file_watcher
+
+# How long the server may hold a long-poll open before answering no_update
+POLL_WAIT = 30
+# The server sends a keep-alive comment every 15s, so a silent stream is dead
+STREAM_READ_TIMEOUT = 45
+# Reconnect delays grow from RECONNECT_MIN to RECONNECT_MAX seconds, with jitter
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+# How often the metrics file is rewritten
+METRICS_INTERVAL = 15
+
+def parse_retry_after(value):
+    # Seconds from a Retry-After header (delay-seconds or HTTP-date), None if missing or invalid
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+class Backoff:
+    """Exponential reconnect delay with full jitter, so clients don't reconnect in lockstep."""
+
+    def __init__(self, minimum=RECONNECT_MIN, maximum=RECONNECT_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+        # Set from the server's Retry-After, the next delay is at least this long
+        self.deferred = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def defer(self, seconds):
+        self.deferred = max(self.deferred, seconds)
+
+    def next_delay(self):
+        ceiling = min(self.maximum, self.minimum * 2 ** self.attempts)
+        self.attempts += 1
+        delay = max(random.uniform(self.minimum, ceiling), self.deferred)
+        self.deferred = 0
+        return delay
 
 class Client:
     # Added timestamp to __init__
-    def __init__(self, group_id, server_address, logger, force_headless=False):
+    def __init__(self, group_id, server_address, logger, force_headless=False, delta=False, metrics_file=None):
         self.group_id = group_id
         self.server_address = server_address
         self.logger = logger
-        self.running = True
         self.clipboard_file = '/tmp/uniclip'
+        # Unsent clipboard content survives restarts here
+        self.outbox_file = os.path.expanduser(f'~/.cache/uniclip/outbox-{group_id}.json')
         self.force_headless = force_headless
+        # Exchange large, slowly changing content as deltas against the previous version
+        self.delta = delta
+        # Client metrics are written to metrics_file in Prometheus text format, if set
+        self.metrics_file = metrics_file
+        self.metrics = ClientMetrics() if metrics_file else None
         self.headless = self._detect_headless()
         self.client_id = self._generate_client_id()
+        self.watcher = None
         self.last_clipboard = ''
         self.last_timestamp = 0
+        # seq of the last group message seen, the poll cursor; None until the server sends one
+        self.last_seq = None
+        # Retry delays of the outbox, stretched by the server's Retry-After when it sheds load
+        self.send_backoff = Backoff()
+        # SHA-256 of last_clipboard, kept alongside it so polls don't rehash the clipboard
+        self.last_digest = self._digest('')
+        # Request encodings the server advertised through its Accept-Encoding header
+        self.server_encodings = set()
+        # digest -> upload_id (None before the server assigned one) of the chunked upload
+        # that has not gone through yet, resumed when the outbox retries it
+        self.uploads = {}
+        # Created on the event loop in main()
+        self.http = None
+        self.outbox = None
+        self.stopping = None
         self.logger.debug(f"Client initialized with group_id: {group_id}, server_address: {server_address}, client_id: {self.client_id}, force_headless: {force_headless}")
 
     def _generate_client_id(self):
@@ -27,6 +107,43 @@ class Client:
         short_uuid = str(uuid.uuid4())[:4]
         return f"{hostname}-{short_uuid}"
 
+    @staticmethod
+    def _digest(content):
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    async def digest(self, content):
+        # Large contents are hashed off the event loop, which the stream, watcher and outbox share
+        if len(content) < DELTA_THRESHOLD:
+            return self._digest(content)
+        return await asyncio.get_event_loop().run_in_executor(None, self._digest, content)
+
+    def set_last_clipboard(self, content, timestamp, digest=None):
+        self.last_clipboard = content
+        self.last_timestamp = timestamp
+        self.last_digest = digest or self._digest(content)
+
+    def advance_seq(self, seq):
+        if seq is not None and (self.last_seq is None or seq > self.last_seq):
+            self.last_seq = seq
+
+    def deferred_by_server(self, response, backoff):
+        # True for 429 and 503, the server shedding load; backoff then waits at least its Retry-After
+        if response.status_code not in (429, 503):
+            return False
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        if delay is not None:
+            backoff.defer(delay)
+        retry = f", retry after {delay:.0f}s" if delay is not None else ""
+        self.logger.warning(f"Server is busy (status {response.status_code}{retry})")
+        return True
+
+    def cursor_params(self):
+        # Servers that number messages are polled with since, older ones compare timestamps
+        params = {"timestamp": self.last_timestamp}
+        if self.last_seq is not None:
+            params["since"] = self.last_seq
+        return params
+
     def _detect_headless(self):
         if self.force_headless:
             self.logger.info("Forced headless mode")
@@ -41,135 +158,501 @@ class Client:
 
     def run(self):
         self.logger.info(f"Running client in {'headless' if self.headless else 'normal'} mode, connecting to {self.server_address}")
-        if self.headless:
-            self.logger.debug("Starting clipboard file monitoring thread")
-            threading.Thread(target=self.monitor_clipboard_file, daemon=True).start()
-        else:
-            self.logger.debug("Starting clipboard monitoring thread")
-            threading.Thread(target=self.monitor_clipboard, daemon=True).start()
-        self.register_with_server()
-        
         try:
-            while self.running:
-                time.sleep(1)
+            asyncio.run(self.main())
         except KeyboardInterrupt:
-            self.logger.info("Stopping client...")
-            self.running = False
+            pass
+        self.logger.info("Client stopped")
 
-    # Modified to use file's last modified time
-    def monitor_clipboard_file(self):
-        last_modified = 0
-        self.logger.debug(f"Starting to monitor clipboard file: {self.clipboard_file}")
-        while self.running:
+    async def main(self):
+        # Everything runs on this one loop: watcher, server sync and uploads share state without locks
+        self.stopping = asyncio.Event()
+        self.outbox = Outbox(self.outbox_file, self.logger)
+        self.outbox.load()
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        # One pooled client keeps a warm keep-alive connection for polls and uploads
+        limits = httpx.Limits(max_connections=4, max_keepalive_connections=2)
+        async with httpx.AsyncClient(base_url=self.server_address, limits=limits,
+                                     timeout=httpx.Timeout(30, connect=10)) as self.http:
+            coroutines = [self.supervise("clipboard watcher", self.watch_clipboard),
+                          self.supervise("server sync", self.sync_with_server),
+                          self.supervise("outbox", lambda: self.outbox.run(self.send_to_server, self.send_backoff))]
+            if self.metrics is not None:
+                coroutines.append(self.supervise("metrics writer", self.write_metrics))
+            tasks = [asyncio.ensure_future(coro) for coro in coroutines]
             try:
-                current_modified = os.path.getmtime(self.clipboard_file)
-                if current_modified != last_modified:
-                    last_modified = current_modified
-                    with open(self.clipboard_file, 'r') as f:
-                        content = f.read()
-                    if content != self.last_clipboard:
-                        self.logger.debug(f"Clipboard file changed. New content: {content[:50]}...")
-                        self.last_clipboard = content
-                        self.last_timestamp = int(current_modified)
-                        self.send_to_server(content, self.last_timestamp)
-            except FileNotFoundError:
-                self.logger.debug(f"Clipboard file not found. Creating: {self.clipboard_file}")
-                open(self.clipboard_file, 'a').close()
+                await self.stopping.wait()
+            finally:
+                self.logger.info("Stopping client...")
+                if self.watcher is not None:
+                    self.watcher.stop()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.outbox.save()
+                if self.metrics is not None:
+                    self.save_metrics()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def supervise(self, name, start):
+        # Runs start() until it returns, restarting it with backoff after an unexpected error,
+        # so a bug in one task doesn't leave the client running without syncing
+        backoff = Backoff()
+        while True:
+            try:
+                return await start()
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                self.logger.error(f"Error monitoring clipboard file: {e}")
-            time.sleep(0.5)
+                delay = backoff.next_delay()
+                self.logger.error(f"Unexpected error in {name}: {e!r}. Restarting in {delay:.1f}s", exc_info=True)
+                await asyncio.sleep(delay)
+
+    async def write_metrics(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            await loop.run_in_executor(None, self.save_metrics)
+
+    def save_metrics(self):
+        try:
+            self.metrics.write_textfile(self.metrics_file)
+        except OSError as e:
+            self.logger.error(f"Error writing metrics to {self.metrics_file}: {e}")
+
+    async def timed(self, name, request):
+        # Awaits an HTTP request, recording its round-trip time when metrics are enabled
+        start = time.monotonic()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            if self.metrics is not None:
+                self.metrics.request_errors.inc(name)
+            raise
+        if self.metrics is not None:
+            self.metrics.request_seconds.observe(time.monotonic() - start, name)
+        return response
 
-    # Modified to record timestamp when copying
-    def monitor_clipboard(self):
-        self.logger.debug("Starting to monitor system clipboard")
-        while self.running:
+    def on_clipboard_change(self, content, timestamp):
+        if isinstance(content, FileContent):
+            # Hashed when it is sent, off the event loop, and dropped there if unchanged
+            self.logger.debug(f"Clipboard file changed ({content.size} bytes)")
+            self.outbox.put(content, timestamp)
+            return
+        if content != self.last_clipboard:
+            self.logger.debug(f"Clipboard content changed. New content: {content[:50]}...")
+            base = (self.last_clipboard, self.last_digest)
+            self.set_last_clipboard(content, timestamp)
+            self.outbox.put(content, self.last_timestamp, base)
+
+    async def watch_clipboard(self):
+        if not self.headless:
+            self.watcher = AdaptiveClipboardWatcher(self.logger)
             try:
-                current_clipboard = pyperclip.paste()
-                if current_clipboard != self.last_clipboard:
-                    self.logger.debug(f"Clipboard content changed. New content: {current_clipboard[:50]}...")
-                    self.last_clipboard = current_clipboard
-                    self.last_timestamp = int(time.time())
-                    self.send_to_server(current_clipboard, self.last_timestamp)
+                await self.watcher.run(self.on_clipboard_change)
+                return
             except pyperclip.PyperclipException as e:
                 self.logger.error(f"Error accessing clipboard: {e}")
                 self.logger.info("Switching to headless mode")
                 self.headless = True
-                self.logger.debug("Starting clipboard file monitoring thread")
-                threading.Thread(target=self.monitor_clipboard_file, daemon=True).start()
-                break
-            time.sleep(0.5)
+        await self.monitor_clipboard_file()
 
-    def register_with_server(self):
+    async def monitor_clipboard_file(self):
+        self.logger.debug(f"Starting to monitor clipboard file: {self.clipboard_file}")
+        self.watcher = create_file_watcher(self.clipboard_file, self.logger)
+        try:
+            await self.watcher.run(self.on_clipboard_change)
+        except Exception as e:
+            self.logger.error(f"Error watching clipboard file, falling back to polling: {e}")
+            self.watcher = PollingFileWatcher(self.clipboard_file, self.logger)
+            await self.watcher.run(self.on_clipboard_change)
+
+    async def sync_with_server(self):
+        # Registers, then follows the group's updates, reconnecting with backoff on failure
+        backoff = Backoff()
+        registered = False
+        use_stream = True
+        while True:
+            try:
+                if not registered:
+                    await self.register_with_server()
+                    registered = True
+                    # A restarted server may number messages from scratch, go by timestamp until it sends a seq
+                    self.last_seq = None
+                    self.outbox.wake()
+                if use_stream:
+                    use_stream = await self.stream_server(backoff)
+                else:
+                    await self.long_poll_server()
+                    backoff.reset()
+            except (httpx.HTTPError, ValueError) as e:
+                if isinstance(e, httpx.HTTPStatusError):
+                    self.deferred_by_server(e.response, backoff)
+                delay = backoff.next_delay()
+                self.logger.error(f"Error talking to server: {e}. Reconnecting in {delay:.1f}s")
+                # The server may have restarted and forgotten us
+                registered = False
+                await asyncio.sleep(delay)
+
+    async def register_with_server(self):
         self.logger.debug(f"Attempting to register with server: {self.server_address}")
+        response = await self.timed("register", self.http.post("/register", json={
+            "group_id": self.group_id,
+            "client_id": self.client_id
+        }))
+        self.server_encodings = parse_accept_encoding(response.headers.get('Accept-Encoding'))
+        response.raise_for_status()
+        self.logger.info("Registered with server successfully")
+
+    async def stream_server(self, backoff):
+        # Returns False when the server has no event stream and long-polling should be used instead
+        self.logger.debug("Opening event stream to server")
+        params = dict(self.cursor_params(), hash=self.last_digest, delta=self.delta)
+        async with self.http.stream("GET", f"/stream/{self.group_id}/{self.client_id}", params=params,
+                                    timeout=httpx.Timeout(10, read=STREAM_READ_TIMEOUT)) as response:
+            if response.status_code == 404:
+                self.logger.info("Server does not support event streams, falling back to long-polling")
+                return False
+            response.raise_for_status()
+            self.logger.info("Event stream to server established")
+            backoff.reset()
+            data_lines = []
+            async for line in response.aiter_lines():
+                line = line.rstrip("\r\n")
+                if line.startswith("data:"):
+                    data_lines.append(line[5:].strip())
+                elif not line and data_lines:
+                    data = json.loads("\n".join(data_lines))
+                    data_lines = []
+                    await self.handle_poll_response(data)
+        self.logger.debug("Event stream closed by server, reconnecting")
+        return True
+
+    # Modified to include content hash and timestamp
+    async def long_poll_server(self):
+        self.logger.debug(f"Polling server: {self.server_address}/poll/{self.group_id}/{self.client_id}")
+        response = await self.timed("poll", self.http.get(
+            f"/poll/{self.group_id}/{self.client_id}",
+            params=dict(self.cursor_params(), hash=self.last_digest, wait=POLL_WAIT, delta=self.delta),
+            timeout=httpx.Timeout(10, read=POLL_WAIT + 15)))
+        response.raise_for_status()
+        await self.handle_poll_response(response.json())
+
+    async def handle_poll_response(self, data):
+        status = data.get('status')
+        if status == 'update_needed' and 'mime_type' in data:
+            await self.apply_blob_update(data)
+        elif status == 'update_needed':
+            await self.apply_update(data.get('content'), data.get('timestamp'), data.get('hash'), data.get('seq'))
+        elif status == 'update_delta':
+            await self.apply_delta_update(data)
+        elif status == 'not_modified':
+            self.logger.debug("Server content matches local clipboard")
+            self.last_timestamp = max(self.last_timestamp, data.get('timestamp', 0))
+            self.advance_seq(data.get('seq'))
+        else:
+            self.logger.debug("No new content received from server")
+
+    async def apply_delta_update(self, data):
+        if data.get('hash') == self.last_digest:
+            # Our own delta echoed back by the stream; its base is the content we had before
+            self.last_timestamp = max(self.last_timestamp, data.get('timestamp', 0))
+            self.advance_seq(data.get('seq'))
+            return
+        content = None
+        if data.get('base_hash') == self.last_digest:
+            try:
+                content = await asyncio.get_event_loop().run_in_executor(
+                    None, apply_delta, self.last_clipboard, data.get('delta') or [])
+            except (ValueError, TypeError) as e:
+                self.logger.warning(f"Could not apply delta from server: {e}")
+        if content is None or await self.digest(content) != data.get('hash'):
+            self.logger.info("Delta from server does not match local clipboard, fetching full content")
+            await self.fetch_full_update()
+            return
+        self.logger.debug(f"Applied delta from server ({len(data['delta'])} ops)")
+        await self.apply_update(content, data.get('timestamp'), data.get('hash'), data.get('seq'))
+
+    async def fetch_full_update(self):
         try:
-            response = requests.post(f"{self.server_address}/register", json={
-                "group_id": self.group_id,
-                "client_id": self.client_id
-            })
+            # With our hash the server answers not_modified instead of resending what we hold
+            response = await self.timed("fetch", self.http.get(f"/poll/{self.group_id}/{self.client_id}",
+                                                               params=dict(self.cursor_params(), hash=self.last_digest)))
             if response.status_code == 200:
-                self.logger.info("Registered with server successfully")
-                self.logger.debug("Starting server polling thread")
-                threading.Thread(target=self.poll_server, daemon=True).start()
+                await self.handle_poll_response(response.json())
             else:
-                self.logger.error(f"Failed to register with server. Status code: {response.status_code}")
-        except requests.RequestException as e:
-            self.logger.error(f"Error connecting to server: {e}")
+                self.logger.warning(f"Unexpected status code from server: {response.status_code}")
+        except httpx.HTTPError as e:
+            self.logger.error(f"Error fetching full content from server: {e}")
 
-    # Modified to include content hash and timestamp
-    def poll_server(self):
-        self.logger.debug("Starting to poll server for updates")
-        while self.running:
+    async def apply_update(self, clipboard_content, timestamp, digest=None, seq=None):
+        if not clipboard_content or not timestamp:
+            self.advance_seq(seq)
+            return
+        if digest is not None and digest == self.last_digest:
+            # Our own update echoed back by the stream
+            self.last_timestamp = max(self.last_timestamp, timestamp)
+            self.advance_seq(seq)
+            return
+        self.logger.debug(f"Received new content from server: {clipboard_content[:50]}...")
+        self.outbox.discard_older(timestamp)
+        # Record the content first so the watcher doesn't report it back as a local change
+        self.set_last_clipboard(clipboard_content, timestamp, digest)
+        self.advance_seq(seq)
+        if self.headless:
+            self.update_clipboard_file(clipboard_content)
+        else:
+            try:
+                # copy() forks a helper process, keep it off the event loop
+                await asyncio.get_event_loop().run_in_executor(None, pyperclip.copy, clipboard_content)
+                self.logger.debug("Successfully copied new content to clipboard")
+            except pyperclip.PyperclipException as e:
+                self.logger.error(f"Error copying to clipboard: {e}")
+                self.logger.info("Switching to headless mode")
+                self.headless = True
+                self.update_clipboard_file(clipboard_content)
+        self.on_received(timestamp)
+
+    def on_received(self, timestamp):
+        if self.watcher is not None:
+            self.watcher.poke()
+        self.logger.info("Received new clipboard content from server")
+        if self.metrics is not None:
+            self.metrics.updates.inc('received')
+            # Timestamps come from the sending device's clock, so skew shows up here too
+            self.metrics.sync_lag.observe(max(0, time.time() - timestamp))
+
+    async def apply_blob_update(self, data):
+        # An uploaded content, downloaded from /blobs; errors propagate so the poll is retried
+        digest, timestamp, mime_type, size = data.get('hash'), data.get('timestamp'), data.get('mime_type'), data.get('size')
+        seq = data.get('seq')
+        if not digest or not timestamp:
+            return
+        if digest == self.last_digest:
+            self.last_timestamp = max(self.last_timestamp, timestamp)
+            self.advance_seq(seq)
+            return
+        self.logger.debug(f"Received {size} bytes of {mime_type} content from server")
+        if self.headless:
+            if not await self.download_to_file(digest, size, timestamp):
+                return
+            self.advance_seq(seq)
+            self.on_received(timestamp)
+        elif is_text(mime_type):
+            response = await self.timed("download", self.http.get(f"/blobs/{self.group_id}/{digest}"))
+            response.raise_for_status()
+            await self.apply_update(response.content.decode('utf-8', errors='replace'), timestamp, digest, seq)
+        else:
+            self.logger.info(f"Skipping {mime_type} content from server, the system clipboard only takes text")
+            self.last_timestamp = max(self.last_timestamp, timestamp)
+            self.advance_seq(seq)
+
+    async def download_to_file(self, digest, size, timestamp):
+        # Streams the blob into the clipboard file, continuing a partial download from an earlier attempt
+        loop = asyncio.get_event_loop()
+        part_path = f"{self.clipboard_file}.{digest[:16]}.part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if 0 < offset < size else {}
+        if offset < size:
+            async with self.http.stream("GET", f"/blobs/{self.group_id}/{digest}", headers=headers) as response:
+                if response.status_code not in (200, 206):
+                    self.logger.error(f"Failed to download content from server. Status code: {response.status_code}")
+                    return False
+                if offset:
+                    self.logger.info(f"Resuming download at byte {offset} of {size}")
+                with open(part_path, 'ab' if response.status_code == 206 else 'wb') as f:
+                    async for chunk in response.aiter_bytes():
+                        await loop.run_in_executor(None, f.write, chunk)
+        if await loop.run_in_executor(None, file_digest, part_path) != digest:
+            self.logger.error("Downloaded content does not match its hash, discarding it")
+            os.remove(part_path)
+            return False
+        self.outbox.discard_older(timestamp)
+        # Record the content first so the watcher doesn't report it back as a local change
+        self.set_last_clipboard(FileContent(self.clipboard_file, size), timestamp, digest)
+        os.replace(part_path, self.clipboard_file)
+        return True
+
+    @staticmethod
+    def hash_file(path):
+        # (digest, size, mime_type) of a clipboard file, read in chunks
+        digest = hashlib.sha256()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        size, prefix, text = 0, b'', True
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                if not size:
+                    prefix = chunk[:64]
+                size += len(chunk)
+                digest.update(chunk)
+                if text:
+                    try:
+                        decoder.decode(chunk)
+                    except UnicodeDecodeError:
+                        text = False
+        if text:
             try:
-                content_hash = hashlib.md5(self.last_clipboard.encode()).hexdigest()
-                self.logger.debug(f"Polling server: {self.server_address}/poll/{self.group_id}/{self.client_id}")
-                response = requests.get(f"{self.server_address}/poll/{self.group_id}/{self.client_id}", 
-                                        params={"hash": content_hash, "timestamp": self.last_timestamp})
+                decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                text = False
+        return digest.hexdigest(), size, TEXT_MIME_TYPE if text else sniff_mime_type(prefix)
+
+    async def send_file(self, content, timestamp):
+        loop = asyncio.get_event_loop()
+        try:
+            digest, size, mime_type = await loop.run_in_executor(None, self.hash_file, content.path)
+        except OSError as e:
+            self.logger.error(f"Error reading clipboard file: {e}")
+            return True
+        if digest == self.last_digest and digest not in self.uploads:
+            self.logger.debug("Clipboard file matches the last synced content")
+            return True
+        self.set_last_clipboard(content, timestamp, digest)
+
+        def read_chunk(offset):
+            with open(content.path, 'rb') as f:
+                f.seek(offset)
+                return f.read(CHUNK_SIZE)
+
+        async def read_file_chunk(offset):
+            return await loop.run_in_executor(None, read_chunk, offset)
+
+        return await self.upload(read_file_chunk, size, digest, mime_type, timestamp)
+
+    async def upload(self, read_chunk, size, digest, mime_type, timestamp):
+        # Sends content through a chunked upload, picking up where a failed attempt stopped.
+        # Returns False when the upload should be retried later.
+        if digest not in self.uploads:
+            self.uploads = {digest: None}
+        done = await self.send_chunks(read_chunk, size, digest, mime_type, timestamp)
+        if done:
+            self.uploads.pop(digest, None)
+        return done
+
+    async def send_chunks(self, read_chunk, size, digest, mime_type, timestamp):
+        upload_id = self.uploads.get(digest)
+        offset = None
+        try:
+            if upload_id is not None:
+                response = await self.timed("upload", self.http.get(f"/uploads/{upload_id}"))
                 if response.status_code == 200:
-                    data = response.json()
-                    if data.get('status') == 'update_needed':
-                        clipboard_content = data.get('content')
-                        timestamp = data.get('timestamp')
-                        if clipboard_content and timestamp:
-                            self.logger.debug(f"Received new content from server: {clipboard_content[:50]}...")
-                            if self.headless:
-                                self.update_clipboard_file(clipboard_content)
-                            else:
-                                try:
-                                    pyperclip.copy(clipboard_content)
-                                    self.logger.debug("Successfully copied new content to clipboard")
-                                except pyperclip.PyperclipException as e:
-                                    self.logger.error(f"Error copying to clipboard: {e}")
-                                    self.logger.info("Switching to headless mode")
-                                    self.headless = True
-                                    self.update_clipboard_file(clipboard_content)
-                            self.last_clipboard = clipboard_content
-                            self.last_timestamp = timestamp
-                            self.logger.info("Received new clipboard content from server")
-                    else:
-                        self.logger.debug("No new content received from server")
+                    offset = response.json()['offset']
+                    self.logger.info(f"Resuming upload at byte {offset} of {size}")
+            if offset is None:
+                response = await self.timed("upload", self.http.post("/uploads", json={
+                    "group_id": self.group_id, "client_id": self.client_id,
+                    "size": size, "hash": digest, "mime_type": mime_type}))
+                if self.deferred_by_server(response, self.send_backoff):
+                    return False
+                if response.status_code != 200:
+                    self.logger.error(f"Failed to start upload. Status code: {response.status_code}")
+                    return response.status_code < 500
+                upload_id = self.uploads[digest] = response.json()['upload_id']
+                offset = 0
+                self.logger.info(f"Uploading {size} bytes of {mime_type} content")
+            while True:
+                if offset < size:
+                    chunk = await read_chunk(offset)
+                    if not chunk:
+                        self.logger.info("Clipboard content changed during upload, dropping it")
+                        return True
+                    response = await self.timed("upload", self.http.put(
+                        f"/uploads/{upload_id}", params={"offset": offset}, content=chunk,
+                        headers={"Content-Type": "application/octet-stream"}))
                 else:
-                    self.logger.warning(f"Unexpected status code from server: {response.status_code}")
-                time.sleep(0.5)
-            except requests.RequestException as e:
-                self.logger.error(f"Error polling server: {e}")
-                time.sleep(5)
-
-    # Modified to include timestamp
-    def send_to_server(self, content, timestamp):
+                    response = await self.timed("upload", self.http.post(
+                        f"/uploads/{upload_id}/complete", json={"timestamp": timestamp}))
+                    if response.status_code == 200:
+                        self.advance_seq(response.json().get('seq'))
+                        break
+                if response.status_code in (200, 409) and 'offset' in response.json():
+                    # 409: the server holds a different amount than we thought, continue from its offset
+                    offset = response.json()['offset']
+                    continue
+                if self.deferred_by_server(response, self.send_backoff):
+                    return False
+                self.logger.error(f"Upload failed. Status code: {response.status_code}")
+                if response.status_code == 404:
+                    # Expired or finished elsewhere, the retry starts a new upload
+                    self.uploads[digest] = None
+                    return False
+                return response.status_code < 500
+        except httpx.HTTPError as e:
+            where = f" at byte {offset} of {size}" if offset is not None else ""
+            self.logger.error(f"Upload interrupted{where}: {e}")
+            return False
+        self.logger.info(f"Sent {size} bytes of {mime_type} content to server")
+        if self.metrics is not None:
+            self.metrics.updates.inc('sent')
+        return True
+
+    # base is the (content, digest) the server is expected to hold, used as the delta base.
+    # Returns False when the update should be retried later.
+    async def send_to_server(self, content, timestamp, base=None):
+        if isinstance(content, FileContent):
+            return await self.send_file(content, timestamp)
+        if len(content) >= UPLOAD_THRESHOLD:
+            return await self.send_text_upload(content, timestamp)
         self.logger.debug(f"Sending update to server: {content[:50]}...")
+        update = {
+            "group_id": self.group_id,
+            "client_id": self.client_id,
+            "timestamp": timestamp
+        }
+        if self.delta and base and isinstance(base[0], str) and base[0] and len(content) >= DELTA_THRESHOLD:
+            # Diffing large contents takes seconds, keep it off the event loop like the server does
+            ops = await asyncio.get_event_loop().run_in_executor(None, make_delta, base[0], content)
+            if worth_sending(ops, content):
+                self.logger.debug(f"Sending update as a delta of {len(ops)} ops")
+                update.update(delta=ops, base_hash=base[1], hash=await self.digest(content))
+        if "delta" not in update:
+            update["content"] = content
+        body = json.dumps(update).encode()
+        headers = {"Content-Type": "application/json"}
+        encoding = negotiate(', '.join(self.server_encodings)) if len(body) >= COMPRESSION_THRESHOLD else None
+        if encoding is not None:
+            self.logger.debug(f"Compressing {len(body)} byte update with {encoding}")
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
         try:
-            response = requests.post(f"{self.server_address}/update", json={
-                "group_id": self.group_id,
-                "client_id": self.client_id,
-                "content": content,
-                "timestamp": timestamp
-            })
-            if response.status_code == 200:
-                self.logger.info(f"Sent update to server: {content[:20]}...")
-            else:
-                self.logger.error(f"Failed to send update to server. Status code: {response.status_code}")
-        except requests.RequestException as e:
+            response = await self.timed("update", self.http.post("/update", content=body, headers=headers))
+        except httpx.HTTPError as e:
             self.logger.error(f"Error sending update to server: {e}")
+            return False
+        if response.status_code == 200:
+            self.logger.info(f"Sent update to server: {content[:20]}...")
+            # Messages before ours are older than our clipboard, so the cursor can move past them
+            self.advance_seq(response.json().get('seq'))
+            if self.metrics is not None:
+                self.metrics.updates.inc('sent')
+        elif response.status_code == 409 and "delta" in update:
+            self.logger.info("Server cannot apply delta, resending full content")
+            return await self.send_to_server(content, timestamp)
+        elif response.status_code == 413:
+            self.logger.info("Update is larger than the server accepts, sending it as an upload")
+            return await self.send_text_upload(content, timestamp)
+        elif self.deferred_by_server(response, self.send_backoff):
+            return False
+        else:
+            self.logger.error(f"Failed to send update to server. Status code: {response.status_code}")
+            # Client errors won't go away by retrying the same update
+            return response.status_code < 500
+        return True
+
+    async def send_text_upload(self, content, timestamp):
+        payload = content.encode('utf-8')
+
+        async def read_text_chunk(offset):
+            return payload[offset:offset + CHUNK_SIZE]
+
+        return await self.upload(read_text_chunk, len(payload), await self.digest(content), TEXT_MIME_TYPE, timestamp)
 
     def update_clipboard_file(self, content):
         self.logger.debug(f"Updating clipboard file with new content: {content[:50]}...")
@@ -0,0 +1,143 @@
+import gzip
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies smaller than this are sent as-is; compressing them costs more than it saves
+COMPRESSION_THRESHOLD = 4096
+
+def available_encodings():
+    # In order of preference
+    return ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+def decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+class DecompressedTooLarge(ValueError):
+    pass
+
+def decompress_limited(data, encoding, max_size):
+    # Like decompress, but stops inflating past max_size bytes so a small body cannot expand without bound
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(wbits=31)
+        body = decompressor.decompress(data, max_size + 1)
+        if len(body) <= max_size and not decompressor.eof:
+            raise ValueError("Truncated gzip data")
+    elif encoding == 'zstd' and zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            body = reader.read(max_size + 1)
+    else:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+    if len(body) > max_size:
+        raise DecompressedTooLarge(f"Decompressed body is larger than {max_size} bytes")
+    return body
+
+def decompress_prefix(data, encoding, length):
+    # First length bytes of the decompressed data, without inflating the rest
+    if encoding == 'gzip':
+        return zlib.decompressobj(wbits=31).decompress(data, length)
+    if encoding == 'zstd' and zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            return reader.read(length)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+def parse_accept_encoding(header):
+    accepted = set()
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+def negotiate(header, supported=None):
+    # Picks the preferred encoding both sides support, or None for identity
+    accepted = parse_accept_encoding(header)
+    for encoding in supported or available_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+class DecompressionMiddleware:
+    """ASGI middleware that inflates gzip/zstd request bodies and advertises them.
+
+    Responses carry an Accept-Encoding header so clients know which request
+    encodings the server understands. Bodies inflating to more than max_size
+    bytes are refused with 413.
+    """
+
+    def __init__(self, app, max_size=None):
+        self.app = app
+        self.max_size = max_size
+        self.advertised = ', '.join(available_encodings()).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_encodings(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(b'accept-encoding', self.advertised)]
+            await send(message)
+
+        headers = dict(scope['headers'])
+        encoding = headers.get(b'content-encoding', b'').decode().strip().lower()
+        if not encoding or encoding == 'identity':
+            return await self.app(scope, receive, send_with_encodings)
+        if encoding not in available_encodings():
+            return await self.reject(send, 415, f"Unsupported Content-Encoding: {encoding}")
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        try:
+            if self.max_size is None:
+                body = decompress(b''.join(chunks), encoding)
+            else:
+                body = decompress_limited(b''.join(chunks), encoding, self.max_size)
+        except DecompressedTooLarge:
+            return await self.reject(send, 413, f"Request body is larger than {self.max_size} bytes")
+        except Exception:
+            return await self.reject(send, 400, f"Invalid {encoding} request body")
+
+        scope = dict(scope)
+        scope['headers'] = [(k, v) for k, v in scope['headers'] if k not in (b'content-encoding', b'content-length')]
+        scope['headers'].append((b'content-length', str(len(body)).encode()))
+        sent = False
+
+        async def receive_decompressed():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        await self.app(scope, receive_decompressed, send_with_encodings)
+
+    @staticmethod
+    async def reject(send, status, detail):
+        body = json.dumps({"detail": detail}).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
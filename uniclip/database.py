@@ -0,0 +1,567 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .blobs import FTS_MAX_BYTES, BlobStore, content_digest, index_text
+from .compression import decompress_prefix
+
+PRAGMAS = [
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # 16 MiB page cache per connection
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 268435456',
+]
+
+MAX_ID = 2 ** 63 - 1
+
+@contextmanager
+def transaction(conn, mode='DEFERRED'):
+    conn.execute(f'BEGIN {mode}')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+# Schema migrations, applied in order and tracked through PRAGMA user_version
+def _create_messages(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT,
+            content TEXT,
+            client_id TEXT,
+            timestamp INTEGER
+        )
+    ''')
+
+def _index_messages_by_group(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_group_timestamp ON messages (group_id, timestamp)')
+
+def _content_addressed_blobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL,
+            data BLOB,
+            path TEXT
+        )
+    ''')
+    conn.execute('ALTER TABLE messages ADD COLUMN blob_hash TEXT')
+    # Move existing payloads out of messages, keeping them inline in SQLite
+    rows = conn.execute('SELECT id, content FROM messages WHERE content IS NOT NULL').fetchall()
+    for message_id, content in rows:
+        data = content.encode('utf-8')
+        digest = content_digest(data)
+        if not conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,)).rowcount:
+            conn.execute('INSERT INTO blobs (hash, size, refcount, data) VALUES (?, ?, 1, ?)', (digest, len(data), data))
+        conn.execute('UPDATE messages SET blob_hash = ?, content = NULL WHERE id = ?', (digest, message_id))
+
+def _compressed_blobs(conn):
+    conn.execute('ALTER TABLE blobs ADD COLUMN encoding TEXT')
+
+def _index_messages_by_blob(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_blob_hash ON messages (blob_hash, group_id)')
+
+def _retention_support(conn):
+    conn.execute('ALTER TABLE messages ADD COLUMN received_at INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_group_id ON messages (group_id, id)')
+
+def _full_text_search(conn):
+    conn.execute('ALTER TABLE blobs ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE blobs_fts USING fts5(content, content='')")
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5, search stays disabled
+        return
+    # Contents already stored in files predate the index and stay unindexed
+    rows = conn.execute('SELECT rowid, data, encoding FROM blobs WHERE data IS NOT NULL').fetchall()
+    for rowid, data, encoding in rows:
+        prefix = decompress_prefix(data, encoding, FTS_MAX_BYTES) if encoding else data
+        conn.execute('INSERT INTO blobs_fts (rowid, content) VALUES (?, ?)', (rowid, index_text(prefix)))
+        conn.execute('UPDATE blobs SET indexed = 1 WHERE rowid = ?', (rowid,))
+
+def _group_members(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS members (
+            group_id TEXT NOT NULL,
+            client_id TEXT NOT NULL,
+            registered_at INTEGER NOT NULL,
+            PRIMARY KEY (group_id, client_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _member_presence(conn):
+    conn.execute('ALTER TABLE members ADD COLUMN last_seen INTEGER')
+    conn.execute('UPDATE members SET last_seen = registered_at')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_members_last_seen ON members (last_seen)')
+
+def _message_mime_types(conn):
+    # NULL for text sent through /update, the uploaded type for chunked uploads
+    conn.execute('ALTER TABLE messages ADD COLUMN mime_type TEXT')
+
+def _group_sequences(conn):
+    # Per-group message numbers, handed out when a message is accepted (see uniclip.state)
+    conn.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+    last = {}
+    rows = conn.execute('SELECT id, group_id FROM messages ORDER BY id').fetchall()
+    for message_id, group_id in rows:
+        last[group_id] = last.get(group_id, 0) + 1
+        conn.execute('UPDATE messages SET seq = ? WHERE id = ?', (last[group_id], message_id))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_group_seq ON messages (group_id, seq)')
+    # Next number per group for server processes sharing the database
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sequences (
+            group_id TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.executemany('INSERT INTO sequences (group_id, seq) VALUES (?, ?)', last.items())
+
+MIGRATIONS = [
+    _create_messages,
+    _index_messages_by_group,
+    _content_addressed_blobs,
+    _compressed_blobs,
+    _index_messages_by_blob,
+    _retention_support,
+    _full_text_search,
+    _group_members,
+    _member_presence,
+    _message_mime_types,
+    _group_sequences,
+]
+
+class DatabaseManager:
+    """SQLite storage for the server.
+
+    Queries run on a small thread pool, each worker thread holding its own
+    connection, so the event loop never blocks on disk I/O.
+    """
+
+    def __init__(self, logger, db_name='uniclip.db', blob_store=None, pool_size=4):
+        self.logger = logger
+        self.db_name = db_name
+        self.blob_store = blob_store or BlobStore()
+        self.pool_size = pool_size
+        self.executor = None
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # Optional histogram observing (seconds, operation) for every query, see uniclip.metrics
+        self.timer = None
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        with self.connections_lock:
+            self.connections.append(conn)
+        return conn
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def init_db(self):
+        conn = self.get_connection()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Incremental auto-vacuum lets retention hand free pages back to the filesystem;
+            # switching an existing database over needs one full VACUUM
+            self.logger.info("Enabling incremental auto-vacuum")
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        conn.execute('PRAGMA journal_mode = WAL')
+        self.migrate(conn)
+        self.blob_store.fts_enabled = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blobs_fts'").fetchone() is not None
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='uniclip-db')
+
+    def migrate(self, conn):
+        # BEGIN IMMEDIATE serializes concurrent migrators on the same file
+        with transaction(conn, 'IMMEDIATE'):
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                self.logger.info(f"Applying database migration {number}: {migration.__name__.strip('_')}")
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+    async def run(self, func, *args):
+        # Runs func(conn, *args) on a pool thread using that thread's connection
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, self._call, func, args)
+        finally:
+            if self.timer is not None:
+                self.timer.observe(time.perf_counter() - start, func.__name__.strip('_'))
+
+    def _call(self, func, args):
+        return func(self.get_connection(), *args)
+
+    async def record_message(self, group_id, content, client_id, timestamp, digest=None, seq=None):
+        await self.record_messages([(group_id, content, client_id, timestamp, digest, seq)])
+
+    async def record_messages(self, rows):
+        # rows of (group_id, content, client_id, timestamp, digest or None, seq), committed in a single transaction
+        await self.run(self._record_messages, rows)
+
+    async def record_file_message(self, group_id, client_id, timestamp, source, digest, size, mime_type, seq):
+        # Stores a verified upload, moving the file at source into the blob store
+        await self.run(self._record_file_message, group_id, client_id, timestamp, source, digest, size, mime_type, seq)
+
+    async def get_latest_message(self, group_id):
+        # (id, group_id, content, client_id, timestamp, digest, mime_type, size, seq) of the message
+        # with the highest seq; content is None for uploaded messages, which are only read through get_blob
+        return await self.run(self._get_latest_message, group_id)
+
+    async def max_seq(self, group_id):
+        # Highest seq the database knows was handed out for group_id, 0 if none
+        return await self.run(self._max_seq, group_id)
+
+    async def next_seq(self, group_id):
+        # Allocates the next seq of group_id through the sequences table, for processes sharing the database
+        return await self.run(self._next_seq, group_id)
+
+    async def get_blob(self, group_id, digest):
+        # (size, data, path, encoding, mime_type) of a blob referenced by a message in group_id, or None
+        return await self.run(self._get_blob, group_id, digest)
+
+    # Shared state between server processes, see uniclip.state
+
+    async def last_message_id(self):
+        return await self.run(self._last_message_id)
+
+    async def messages_after(self, after_id, limit=1000):
+        # (id, group_id, seq, blob_hash) of messages stored after after_id, oldest first
+        return await self.run(self._messages_after, after_id, limit)
+
+    async def touch_member(self, group_id, client_id, now):
+        # Records that the client was seen at now, adding it to the group if needed
+        await self.run(self._touch_member, group_id, client_id, now)
+
+    async def get_members(self, group_id, seen_since):
+        # {client_id: (registered_at, last_seen)} of clients seen since seen_since
+        return await self.run(self._get_members, group_id, seen_since)
+
+    async def member_counts(self, seen_since):
+        # (groups, clients) seen since seen_since
+        return await self.run(self._member_counts, seen_since)
+
+    async def evict_members(self, seen_before):
+        return await self.run(self._evict_members, seen_before)
+
+    # Retention: every delete call handles at most batch_size messages in its own short
+    # transaction. The newest message of each group is never deleted so polls keep working.
+
+    async def groups_over(self, keep_last):
+        return await self.run(self._groups_over, keep_last)
+
+    async def trim_group(self, group_id, keep_last, batch_size):
+        return await self.run(self._trim_group, group_id, keep_last, batch_size)
+
+    async def delete_window(self, after_id, batch_size, expired_before=None, protected=frozenset()):
+        return await self.run(self._delete_window, after_id, batch_size, expired_before, protected)
+
+    async def latest_blob_hashes(self):
+        return await self.run(self._latest_blob_hashes)
+
+    async def reclaimable_blob_bytes(self):
+        return await self.run(self._reclaimable_blob_bytes)
+
+    async def incremental_vacuum(self, max_pages):
+        # Returns the number of bytes handed back to the filesystem
+        return await self.run(self._incremental_vacuum, max_pages)
+
+    # History and search page through a group by message id, newest first: pass the
+    # smallest id of the previous page as before to get the next one
+
+    async def get_history(self, group_id, before=None, limit=50, preview_chars=200):
+        return await self.run(self._get_history, group_id, before, limit, preview_chars)
+
+    async def search(self, group_id, query, before=None, limit=50, preview_chars=200):
+        return await self.run(self._search, group_id, query, before, limit, preview_chars)
+
+    async def get_message(self, group_id, message_id):
+        return await self.run(self._get_message, group_id, message_id)
+
+    async def get_content(self, group_id, digest):
+        # Text of a blob referenced by a message in group_id, or None
+        return await self.run(self._get_content, group_id, digest)
+
+    def _record_messages(self, conn, rows):
+        received_at = int(time.time())
+        with transaction(conn, 'IMMEDIATE'):
+            for group_id, content, client_id, timestamp, digest, seq in rows:
+                digest = self.blob_store.add(conn, content.encode('utf-8'), digest)
+                conn.execute('''
+                    INSERT INTO messages (group_id, blob_hash, client_id, timestamp, received_at, seq)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (group_id, digest, client_id, timestamp, received_at, seq))
+                self._store_seq(conn, group_id, seq)
+
+    def _record_file_message(self, conn, group_id, client_id, timestamp, source, digest, size, mime_type, seq):
+        with transaction(conn, 'IMMEDIATE'):
+            self.blob_store.adopt(conn, source, digest, size)
+            conn.execute('''
+                INSERT INTO messages (group_id, blob_hash, client_id, timestamp, received_at, mime_type, seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (group_id, digest, client_id, timestamp, int(time.time()), mime_type, seq))
+            self._store_seq(conn, group_id, seq)
+
+    def _get_latest_message(self, conn, group_id):
+        row = conn.execute('''
+            SELECT m.id, m.group_id, m.content, m.client_id, m.timestamp, m.blob_hash, m.mime_type, m.seq,
+                   b.size, b.data, b.path, b.encoding FROM messages m
+            LEFT JOIN blobs b ON b.hash = m.blob_hash
+            WHERE m.group_id = ?
+            ORDER BY m.seq DESC
+            LIMIT 1
+        ''', (group_id,)).fetchone()
+        if row is None:
+            return None
+        message_id, group_id, content, client_id, timestamp, digest, mime_type, seq, size, data, path, encoding = row
+        if content is None and mime_type is None:
+            content = self.blob_store.read(data, path, encoding).decode('utf-8')
+        return message_id, group_id, content, client_id, timestamp, digest, mime_type, size, seq
+
+    @staticmethod
+    def _max_seq(conn, group_id):
+        # The sequences table remembers numbers of messages that retention has deleted since
+        return conn.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sequences WHERE group_id = ?), 0),
+                       COALESCE((SELECT MAX(seq) FROM messages WHERE group_id = ?), 0))
+        ''', (group_id, group_id)).fetchone()[0]
+
+    @staticmethod
+    def _store_seq(conn, group_id, seq):
+        # Raises the group's high-water mark in the sequences table to a committed message's seq,
+        # so that no backend hands the number out again after a restart
+        if seq is None:
+            return
+        if not conn.execute('UPDATE sequences SET seq = MAX(seq, ?) WHERE group_id = ?', (seq, group_id)).rowcount:
+            conn.execute('INSERT INTO sequences (group_id, seq) VALUES (?, ?)', (group_id, seq))
+
+    def _next_seq(self, conn, group_id):
+        with transaction(conn, 'IMMEDIATE'):
+            # Never below what is stored, in case messages were numbered by a single-process server
+            stored = self._max_seq(conn, group_id)
+            if not conn.execute('UPDATE sequences SET seq = MAX(seq, ?) + 1 WHERE group_id = ?',
+                                (stored, group_id)).rowcount:
+                conn.execute('INSERT INTO sequences (group_id, seq) VALUES (?, ?)', (group_id, stored + 1))
+            return conn.execute('SELECT seq FROM sequences WHERE group_id = ?', (group_id,)).fetchone()[0]
+
+    @staticmethod
+    def _get_blob(conn, group_id, digest):
+        return conn.execute('''
+            SELECT b.size, b.data, b.path, b.encoding, m.mime_type FROM blobs b
+            JOIN messages m ON m.blob_hash = b.hash
+            WHERE b.hash = ? AND m.group_id = ?
+            ORDER BY m.id DESC
+            LIMIT 1
+        ''', (digest, group_id)).fetchone()
+
+    def _get_content(self, conn, group_id, digest):
+        row = conn.execute('''
+            SELECT b.data, b.path, b.encoding FROM blobs b
+            WHERE b.hash = ? AND EXISTS (SELECT 1 FROM messages m
+                                         WHERE m.blob_hash = b.hash AND m.group_id = ? AND m.mime_type IS NULL)
+        ''', (digest, group_id)).fetchone()
+        if row is None:
+            return None
+        return self.blob_store.read(*row).decode('utf-8')
+
+    def _history_entries(self, rows, preview_chars):
+        entries = []
+        for message_id, client_id, timestamp, mime_type, size, data, path, encoding in rows:
+            entry = {"id": message_id, "client_id": client_id, "timestamp": timestamp, "size": size, "preview": ""}
+            if mime_type is None:
+                prefix = self.blob_store.read_prefix(data, path, encoding, preview_chars * 4)
+                entry["preview"] = prefix.decode('utf-8', errors='ignore')[:preview_chars]
+            else:
+                entry["mime_type"] = mime_type
+            entries.append(entry)
+        return entries
+
+    def _get_history(self, conn, group_id, before, limit, preview_chars):
+        rows = conn.execute('''
+            SELECT m.id, m.client_id, m.timestamp, m.mime_type, b.size, b.data, b.path, b.encoding FROM messages m
+            JOIN blobs b ON b.hash = m.blob_hash
+            WHERE m.group_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (group_id, before or MAX_ID, limit)).fetchall()
+        return self._history_entries(rows, preview_chars)
+
+    def _search(self, conn, group_id, query, before, limit, preview_chars):
+        rows = conn.execute('''
+            SELECT m.id, m.client_id, m.timestamp, m.mime_type, b.size, b.data, b.path, b.encoding FROM blobs_fts f
+            JOIN blobs b ON b.rowid = f.rowid
+            JOIN messages m ON m.blob_hash = b.hash
+            WHERE blobs_fts MATCH ? AND m.group_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (query, group_id, before or MAX_ID, limit)).fetchall()
+        return self._history_entries(rows, preview_chars)
+
+    def _get_message(self, conn, group_id, message_id):
+        row = conn.execute('''
+            SELECT m.id, m.client_id, m.timestamp, m.blob_hash, m.mime_type, b.size, b.data, b.path, b.encoding
+            FROM messages m
+            JOIN blobs b ON b.hash = m.blob_hash
+            WHERE m.group_id = ? AND m.id = ?
+        ''', (group_id, message_id)).fetchone()
+        if row is None:
+            return None
+        message_id, client_id, timestamp, digest, mime_type, size, data, path, encoding = row
+        message = {"id": message_id, "client_id": client_id, "timestamp": timestamp}
+        if mime_type is None:
+            message["content"] = self.blob_store.read(data, path, encoding).decode('utf-8')
+        else:
+            # Uploaded contents are downloaded from /blobs/{group_id}/{hash}
+            message.update({"hash": digest, "mime_type": mime_type, "size": size})
+        return message
+
+    @staticmethod
+    def _last_message_id(conn):
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+    @staticmethod
+    def _messages_after(conn, after_id, limit):
+        return conn.execute('''
+            SELECT id, group_id, seq, blob_hash FROM messages WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit)).fetchall()
+
+    @staticmethod
+    def _touch_member(conn, group_id, client_id, now):
+        with transaction(conn, 'IMMEDIATE'):
+            if not conn.execute('UPDATE members SET last_seen = ? WHERE group_id = ? AND client_id = ?',
+                                (now, group_id, client_id)).rowcount:
+                conn.execute('INSERT INTO members (group_id, client_id, registered_at, last_seen) VALUES (?, ?, ?, ?)',
+                             (group_id, client_id, now, now))
+
+    @staticmethod
+    def _get_members(conn, group_id, seen_since):
+        rows = conn.execute('''
+            SELECT client_id, registered_at, last_seen FROM members WHERE group_id = ? AND last_seen >= ?
+        ''', (group_id, seen_since))
+        return {client_id: (registered_at, last_seen) for client_id, registered_at, last_seen in rows}
+
+    @staticmethod
+    def _member_counts(conn, seen_since):
+        return conn.execute('SELECT COUNT(DISTINCT group_id), COUNT(*) FROM members WHERE last_seen >= ?',
+                            (seen_since,)).fetchone()
+
+    @staticmethod
+    def _evict_members(conn, seen_before):
+        return conn.execute('DELETE FROM members WHERE last_seen < ?', (seen_before,)).rowcount
+
+    def _delete_messages(self, conn, rows):
+        # rows of (id, blob_hash); must run inside a transaction. Returns (bytes freed, files to remove)
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id, _ in rows])
+        return self.blob_store.release(conn, [digest for _, digest in rows if digest])
+
+    @staticmethod
+    def _latest_blob_hashes(conn):
+        # Blobs of the newest message (highest seq) of some group, which retention never frees
+        return {row[0] for row in conn.execute('''
+            SELECT m.blob_hash FROM messages m
+            JOIN (SELECT group_id, MAX(seq) AS seq FROM messages GROUP BY group_id) l
+            ON l.group_id = m.group_id AND l.seq = m.seq
+        ''')}
+
+    def _delete_window(self, conn, after_id, batch_size, expired_before=None, protected=frozenset()):
+        # Scans the next batch_size messages after after_id and deletes those that are not the
+        # newest (highest seq) of their group (and, with expired_before, older than it), nor hold
+        # one of the protected blob hashes. Returns (deleted, bytes freed, id to continue after or
+        # None once there is nothing left to scan)
+        with transaction(conn, 'IMMEDIATE'):
+            window = conn.execute('''
+                SELECT id, group_id, seq, blob_hash, COALESCE(received_at, timestamp) FROM messages
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after_id, batch_size)).fetchall()
+            rows = []
+            next_id = window[-1][0] if len(window) == batch_size else None
+            for message_id, group_id, seq, digest, received_at in window:
+                if expired_before is not None and received_at >= expired_before:
+                    # Ids grow with arrival time, everything after this is newer
+                    next_id = None
+                    break
+                if digest in protected:
+                    continue
+                # Uploads skip the write-behind queue, so ids don't always follow seq
+                if conn.execute('SELECT 1 FROM messages WHERE group_id = ? AND seq > ? LIMIT 1',
+                                (group_id, seq)).fetchone():
+                    rows.append((message_id, digest))
+            freed, paths = self._delete_messages(conn, rows) if rows else (0, [])
+        self._remove_files(conn, paths)
+        return len(rows), freed, next_id
+
+    def _remove_files(self, conn, paths):
+        # Files of blobs deleted by a committed transaction. Another one may have stored the same
+        # blob again since, reusing the file, so each is checked under the write lock before it goes
+        if not paths:
+            return
+        with transaction(conn, 'IMMEDIATE'):
+            orphans = [path for path in paths if not conn.execute(
+                'SELECT 1 FROM blobs WHERE hash = ?', (os.path.basename(path),)).fetchone()]
+            self.blob_store.remove_files(orphans)
+
+    @staticmethod
+    def _groups_over(conn, keep_last):
+        return [row[0] for row in conn.execute(
+            'SELECT group_id FROM messages GROUP BY group_id HAVING COUNT(*) > ?', (keep_last,))]
+
+    def _trim_group(self, conn, group_id, keep_last, batch_size):
+        # Keeps the keep_last messages with the highest seq.
+        # Returns (deleted, bytes freed); call until nothing is deleted
+        with transaction(conn, 'IMMEDIATE'):
+            cutoff = conn.execute('''
+                SELECT seq FROM messages WHERE group_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?
+            ''', (group_id, max(keep_last, 1) - 1)).fetchone()
+            rows = []
+            if cutoff is not None:
+                rows = conn.execute('''
+                    SELECT id, blob_hash FROM messages WHERE group_id = ? AND seq < ? ORDER BY seq LIMIT ?
+                ''', (group_id, cutoff[0], batch_size)).fetchall()
+            freed, paths = self._delete_messages(conn, rows) if rows else (0, [])
+        self._remove_files(conn, paths)
+        return len(rows), freed
+
+    @staticmethod
+    def _reclaimable_blob_bytes(conn):
+        # Bytes of blobs that deleting old messages can free: those not held by a group's newest message
+        return conn.execute('''
+            SELECT COALESCE(SUM(size), 0) FROM blobs WHERE hash NOT IN (
+                SELECT blob_hash FROM messages
+                WHERE blob_hash IS NOT NULL AND id IN (
+                    SELECT m.id FROM messages m
+                    JOIN (SELECT group_id, MAX(seq) AS seq FROM messages GROUP BY group_id) l
+                    ON l.group_id = m.group_id AND l.seq = m.seq))
+        ''').fetchone()[0]
+
+    @staticmethod
+    def _incremental_vacuum(conn, max_pages):
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        before = conn.execute('PRAGMA page_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({int(max_pages)})').fetchall()
+        after = conn.execute('PRAGMA page_count').fetchone()[0]
+        return (before - after) * page_size
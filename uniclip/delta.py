@@ -0,0 +1,54 @@
+from difflib import SequenceMatcher
+
+# Only content at least this large is worth diffing
+DELTA_THRESHOLD = 16384
+# A delta is only used when its inserted text is at most this fraction of the full content
+MAX_DELTA_RATIO = 0.5
+
+# A delta is a list of ops applied to the base text from start to end:
+#   ["=", n]     copy the next n characters of the base
+#   ["-", n]     skip the next n characters of the base
+#   ["+", text]  insert text
+
+def make_delta(base, target):
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, base_lines, target_lines).get_opcodes():
+        base_length = sum(len(line) for line in base_lines[i1:i2])
+        if tag == 'equal':
+            ops.append(['=', base_length])
+            continue
+        if base_length:
+            ops.append(['-', base_length])
+        if j2 > j1:
+            ops.append(['+', ''.join(target_lines[j1:j2])])
+    return ops
+
+def apply_delta(base, ops):
+    position = 0
+    parts = []
+    for op, arg in ops:
+        if op in ('=', '-'):
+            if not isinstance(arg, int) or isinstance(arg, bool) or arg < 0:
+                raise ValueError(f"Delta op {op} needs a non-negative count")
+            if position + arg > len(base):
+                raise ValueError("Delta reads past the end of the base")
+            if op == '=':
+                parts.append(base[position:position + arg])
+            position += arg
+        elif op == '+':
+            if not isinstance(arg, str):
+                raise ValueError("Delta op + needs text")
+            parts.append(arg)
+        else:
+            raise ValueError(f"Unknown delta op: {op}")
+    if position != len(base):
+        raise ValueError("Delta does not cover the whole base")
+    return ''.join(parts)
+
+def inserted_size(ops):
+    return sum(len(arg) for op, arg in ops if op == '+')
+
+def worth_sending(ops, target):
+    return inserted_size(ops) <= len(target) * MAX_DELTA_RATIO
@@ -0,0 +1,58 @@
+import time
+import httpx
+
+class HistoryClient:
+    """Reads a group's clipboard history from the server for `uniclip history` and `uniclip search`."""
+
+    def __init__(self, group_id, server_address, logger):
+        self.group_id = group_id
+        self.server_address = server_address
+        self.logger = logger
+
+    def _get(self, path, params=None):
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        try:
+            response = httpx.get(f"{self.server_address}{path}", params=params, timeout=30)
+        except httpx.HTTPError as e:
+            self.logger.error(f"Error connecting to server: {e}")
+            return None
+        if response.status_code != 200:
+            self.logger.error(f"Request failed with status code {response.status_code}: {response.text}")
+            return None
+        return response.json()
+
+    def history(self, limit=20, before=None):
+        return self._get(f"/history/{self.group_id}", {"limit": limit, "before": before})
+
+    def search(self, query, limit=20, before=None):
+        return self._get(f"/search/{self.group_id}", {"q": query, "limit": limit, "before": before})
+
+    def message(self, message_id):
+        return self._get(f"/history/{self.group_id}/{message_id}")
+
+    def download(self, digest, out):
+        # Streams an uploaded content into the binary file object out
+        try:
+            with httpx.stream("GET", f"{self.server_address}/blobs/{self.group_id}/{digest}", timeout=30) as response:
+                if response.status_code != 200:
+                    response.read()
+                    self.logger.error(f"Request failed with status code {response.status_code}: {response.text}")
+                    return False
+                for chunk in response.iter_bytes():
+                    out.write(chunk)
+        except httpx.HTTPError as e:
+            self.logger.error(f"Error connecting to server: {e}")
+            return False
+        out.flush()
+        return True
+
+    @staticmethod
+    def print_page(page):
+        for entry in page["messages"]:
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["timestamp"]))
+            preview = entry["preview"].replace("\n", "\\n")
+            if "mime_type" in entry:
+                preview = f"[{entry['mime_type']}]"
+            print(f"{entry['id']:>8}  {when}  {entry['client_id']:<20} {entry['size']:>8}B  {preview}")
+        if page["next_before"] is not None:
+            print(f"-- more: --before {page['next_before']}")
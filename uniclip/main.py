@@ -1,7 +1,10 @@
 import argparse
 import logging
-from .server import create_server
+from .server import create_server, ServerConfig
 from .client import Client
+from .history import HistoryClient
+from .bench import Benchmark, BenchConfig
+import json
 import os
 import sys
 from .installer import install_client, install_server
@@ -15,6 +18,12 @@ class UniclipConfig:
     group_id: Optional[str] = None
     server_address: Optional[str] = None
     headless: bool = False
+    # Exchange large clipboard contents as deltas against the previous version
+    delta: bool = False
+    # Write client metrics to this file (Prometheus text format)
+    metrics_file: Optional[str] = None
+    # Optional server settings, see ServerConfig
+    server: Optional[dict] = None
 
 class ConfigManager:
     def __init__(self, config_dir='~/.config/uniclip'):
@@ -48,6 +57,8 @@ class UniclipApp:
         client_parser.add_argument('--group', help="Group ID for the client")
         client_parser.add_argument('--server', help="Server address for the client")
         client_parser.add_argument('--headless', action='store_true', help="Force headless mode for client")
+        client_parser.add_argument('--delta', action='store_true', help="Send and receive large contents as deltas")
+        client_parser.add_argument('--metrics-file', help="Periodically write client metrics to this file")
 
         # Server subcommand
         server_parser = subparsers.add_parser('server', help='Run in server mode')
@@ -57,6 +68,36 @@ class UniclipApp:
         # Install subcommand
         subparsers.add_parser('install', help='Install client as a user-mode systemd service')
 
+        # History and search subcommands
+        history_parser = subparsers.add_parser('history', help="Show the group's clipboard history")
+        history_parser.add_argument('--show', type=int, metavar='ID', help="Print the full content of one entry")
+        search_parser = subparsers.add_parser('search', help="Search the group's clipboard history")
+        search_parser.add_argument('query', help="Full-text query (SQLite FTS5 syntax)")
+        for history_subparser in (history_parser, search_parser):
+            history_subparser.add_argument('--group', help="Group ID")
+            history_subparser.add_argument('--server', help="Server address")
+            history_subparser.add_argument('--limit', type=int, default=20, help="Entries per page")
+            history_subparser.add_argument('--before', type=int, help="Only show entries older than this ID")
+
+        # Benchmark subcommand
+        bench_parser = subparsers.add_parser('bench', help='Load-test a server and print latencies as JSON')
+        bench_parser.add_argument('--groups', type=int, default=BenchConfig.groups, help="Number of simulated groups")
+        bench_parser.add_argument('--clients', type=int, default=BenchConfig.clients, help="Clients per group")
+        bench_parser.add_argument('--duration', type=float, default=BenchConfig.duration, help="Seconds of load")
+        bench_parser.add_argument('--update-ratio', type=float, default=BenchConfig.update_ratio,
+                                  help="Fraction of operations that are updates, the rest are polls")
+        bench_parser.add_argument('--payload-median', type=int, default=BenchConfig.payload_median,
+                                  help="Median update size in bytes (sizes are lognormal)")
+        bench_parser.add_argument('--payload-sigma', type=float, default=BenchConfig.payload_sigma,
+                                  help="Spread of the lognormal update size distribution")
+        bench_parser.add_argument('--max-payload', type=int, default=BenchConfig.max_payload, help="Largest update in bytes")
+        bench_parser.add_argument('--think-time', type=float, default=BenchConfig.think_time,
+                                  help="Seconds each client waits between operations")
+        bench_parser.add_argument('--workers', type=int, default=BenchConfig.workers, help="Local server worker processes")
+        bench_parser.add_argument('--durability', default=BenchConfig.durability, help="Local server durability mode")
+        bench_parser.add_argument('--server', help="Benchmark this running server instead of starting a local one")
+        bench_parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+
         # Parse arguments
         args = parser.parse_args()
         
@@ -72,19 +113,52 @@ class UniclipApp:
             if args.server_command == 'install':
                 install_server()
             else:
-                server = create_server(self.logger)
+                server = create_server(self.logger, ServerConfig(**(config.server or {})))
                 server.run()
         elif args.mode == 'client':
             group_id = args.group or config.group_id
             server_address = args.server or config.server_address
             headless = args.headless or config.headless
+            delta = args.delta or config.delta
+            metrics_file = args.metrics_file or config.metrics_file
             if not group_id or not server_address:
                 self.logger.error("Group ID and server address are required for client mode")
                 return
-            client = Client(group_id, server_address, self.logger, headless)
+            client = Client(group_id, server_address, self.logger, headless, delta, metrics_file)
             client.run()
         elif args.mode == 'install':
             install_client()
+        elif args.mode == 'bench':
+            bench_config = BenchConfig(args.groups, args.clients, args.duration, args.update_ratio, args.payload_median,
+                                       args.payload_sigma, args.max_payload, args.think_time, args.workers,
+                                       args.durability, args.server)
+            report = json.dumps(Benchmark(bench_config, self.logger).run(), indent=2)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(report + '\n')
+            else:
+                print(report)
+        elif args.mode in ('history', 'search'):
+            group_id = args.group or config.group_id
+            server_address = args.server or config.server_address
+            if not group_id or not server_address:
+                self.logger.error("Group ID and server address are required")
+                return
+            history = HistoryClient(group_id, server_address, self.logger)
+            if args.mode == 'history' and args.show is not None:
+                message = history.message(args.show)
+                if message and 'content' in message:
+                    print(message['content'])
+                elif message:
+                    # Uploaded contents are written as raw bytes, e.g. to redirect into a file
+                    history.download(message['hash'], sys.stdout.buffer)
+                return
+            if args.mode == 'history':
+                page = history.history(args.limit, args.before)
+            else:
+                page = history.search(args.query, args.limit, args.before)
+            if page:
+                history.print_page(page)
 
 def main():
     app = UniclipApp()
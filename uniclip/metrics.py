@@ -0,0 +1,192 @@
+import bisect
+import os
+import tempfile
+import time
+from starlette.routing import Match
+
+# Latency buckets in seconds, from sub-millisecond cache hits to held long-polls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Minimal Prometheus text-format metrics. Updates are plain dict operations on
+# the event loop, cheap enough to leave on for every request. Each server
+# process keeps its own values.
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Unlabelled series are exported as 0 from the start
+        self.values = {} if self.labelnames else {(): 0}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, self.labelnames, labels, value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        bucket_names = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', bucket_names, labels + (bound,), cumulative
+            yield self.name + '_sum', self.labelnames, labels, total
+            yield self.name + '_count', self.labelnames, labels, cumulative
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Atomically replaces path, for the node_exporter textfile collector
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.uniclip-metrics-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+class ServerMetrics(MetricsRegistry):
+    def __init__(self):
+        super().__init__()
+        self.requests = self.counter('uniclip_http_requests_total', 'HTTP requests by route and status',
+                                     ('method', 'route', 'status'))
+        self.request_seconds = self.histogram('uniclip_http_request_duration_seconds',
+                                              'Time until the response started, long-poll holds included',
+                                              ('method', 'route'))
+        self.db_seconds = self.histogram('uniclip_db_operation_duration_seconds',
+                                         'Database operations including thread pool queueing', ('operation',))
+        self.poll_results = self.counter('uniclip_poll_results_total', 'Poll and stream answers by status',
+                                         ('endpoint', 'status'))
+        self.update_bytes = self.counter('uniclip_update_payload_bytes_total', 'Clipboard bytes received in updates')
+        self.sent_bytes = self.counter('uniclip_poll_payload_bytes_total',
+                                       'Update bytes sent to pollers, after compression', ('encoding',))
+        self.upload_bytes = self.counter('uniclip_upload_chunk_bytes_total', 'Bytes received in upload chunks')
+        self.blob_bytes = self.counter('uniclip_blob_download_bytes_total', 'Bytes served from /blobs')
+        self.groups = self.gauge('uniclip_groups', 'Groups with live clients')
+        self.clients = self.gauge('uniclip_registered_clients', 'Live clients, see presence_ttl')
+        self.cached_groups = self.gauge('uniclip_latest_cache_groups', 'Groups in the latest-message cache')
+        self.cache_lookups = self.counter('uniclip_latest_cache_lookups_total', 'Latest-message cache lookups',
+                                          ('result',))
+        self.waiting_groups = self.gauge('uniclip_notifier_groups', 'Groups that polls or streams are waiting on')
+        self.writer_depth = self.gauge('uniclip_write_queue_depth', 'Messages waiting to be committed')
+        self.rejected = self.counter('uniclip_rejected_updates_total', 'Updates and uploads refused by admission control',
+                                     ('reason',))
+        self.retention = self.counter('uniclip_retention_total', 'Retention work done', ('kind',))
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them until the response starts.
+
+    Requests are labelled with the route template, never the raw path, so
+    group and client ids don't create new series.
+    """
+
+    def __init__(self, app, metrics, routes):
+        self.app = app
+        self.metrics = metrics
+        self.routes = routes
+
+    def route_name(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'other'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        started = False
+
+        def measure(status):
+            method, route = scope['method'], self.route_name(scope)
+            self.metrics.request_seconds.observe(time.perf_counter() - start, method, route)
+            self.metrics.requests.inc(method, route, str(status))
+
+        async def send_and_measure(message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+                measure(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_measure)
+        except Exception:
+            if not started:
+                # Turned into a 500 by the error middleware further out
+                measure(500)
+            raise
+
+class ClientMetrics(MetricsRegistry):
+    def __init__(self):
+        super().__init__()
+        self.request_seconds = self.histogram('uniclip_client_request_duration_seconds',
+                                              'Round-trip time of requests to the server, long-poll holds included',
+                                              ('request',))
+        self.request_errors = self.counter('uniclip_client_request_errors_total', 'Failed requests', ('request',))
+        self.sync_lag = self.histogram('uniclip_client_sync_lag_seconds',
+                                       'Time from a copy on another device to it reaching this clipboard',
+                                       buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 3600))
+        self.updates = self.counter('uniclip_client_updates_total', 'Clipboard updates by direction', ('direction',))
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import tempfile
+
+# Quiet period after the last clipboard change before it is uploaded
+DEBOUNCE = 0.3
+
+class Outbox:
+    """Holds the newest local clipboard change until the server has accepted it.
+
+    Changes that arrive less than `debounce` seconds apart are coalesced, and
+    only the newest one is uploaded. When an upload fails, the pending change
+    is saved to `path` and retried with backoff, or immediately after wake().
+    A change left over from a previous run is picked up by load().
+    """
+
+    def __init__(self, path, logger, debounce=DEBOUNCE):
+        self.path = path
+        self.logger = logger
+        self.debounce = debounce
+        # (content, timestamp, base), see Client.send_to_server
+        self.pending = None
+        self.saved = False
+        self.changed = asyncio.Event()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable outbox file {self.path}: {e}")
+            return
+        self.logger.info("Found clipboard content that was not sent before the last shutdown")
+        self.pending = (data['content'], data['timestamp'], None)
+        self.saved = True
+        self.changed.set()
+
+    def put(self, content, timestamp, base=None):
+        if self.pending is not None:
+            # The server still holds the base of the oldest unsent change
+            self.logger.debug("Coalescing clipboard change with a pending update")
+            base = self.pending[2]
+        self.pending = (content, timestamp, base)
+        self.changed.set()
+
+    def discard_older(self, timestamp):
+        # A newer change from another client wins over our unsent one
+        if self.pending is not None and self.pending[1] < timestamp:
+            self.logger.info("Dropping unsent clipboard change superseded by a newer update from the server")
+            self.pending = None
+            if self.saved:
+                self.remove()
+
+    def wake(self):
+        # Retry a pending upload now, e.g. after reconnecting to the server
+        if self.pending is not None:
+            self.changed.set()
+
+    async def run(self, send, backoff):
+        # send(content, timestamp, base) returns False if the upload should be retried
+        # A change left pending by a run that failed is sent right away
+        self.wake()
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            if self.pending is None:
+                continue
+            await self.settle()
+            entry = self.pending
+            if await send(*entry):
+                backoff.reset()
+                if self.pending is entry:
+                    self.pending = None
+                    if self.saved:
+                        await self.in_executor(self.remove)
+                continue
+            await self.in_executor(self.save)
+            delay = backoff.next_delay()
+            self.logger.info(f"Clipboard update kept in outbox, retrying in {delay:.1f}s")
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.changed.set()
+
+    async def settle(self):
+        # Waits until no change has arrived for `debounce` seconds
+        while True:
+            try:
+                await asyncio.wait_for(self.changed.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                return
+            self.changed.clear()
+
+    @staticmethod
+    async def in_executor(func):
+        await asyncio.get_event_loop().run_in_executor(None, func)
+
+    def save(self):
+        if self.pending is None:
+            return
+        content, timestamp, _ = self.pending
+        if not isinstance(content, str):
+            # A FileContent is reported again by the file watcher after a restart
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.outbox-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'content': content, 'timestamp': timestamp}, f)
+            os.replace(tmp_path, self.path)
+            self.saved = True
+        except OSError as e:
+            self.logger.error(f"Error saving outbox to {self.path}: {e}")
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.error(f"Error removing outbox file {self.path}: {e}")
+        self.saved = False
@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+# Pause between delete batches so writers can take the database lock
+BATCH_PAUSE = 0.01
+
+class RetentionManager:
+    """Background job that keeps the messages table within the configured limits.
+
+    keep_last: messages kept per group
+    max_age:   seconds a message is kept after it was received
+    max_bytes: budget for stored clipboard contents (uncompressed), oldest messages go first
+
+    The newest message of every group is always kept, and its content does
+    not count towards max_bytes. Deletes run in small
+    batches, and freed pages are returned to the filesystem with incremental
+    VACUUM after each pass.
+    """
+
+    def __init__(self, db_manager, logger, keep_last=None, max_age=None, max_bytes=None,
+                 interval=60, batch_size=500, vacuum_pages=1000):
+        self.db_manager = db_manager
+        self.logger = logger
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        # Only groups written since the last pass can exceed keep_last; the first pass checks them all
+        self.dirty_groups = set()
+        self.check_all_groups = True
+        self.stats = {'runs': 0, 'messages_deleted': 0, 'blob_bytes_freed': 0, 'file_bytes_reclaimed': 0}
+        self.task = None
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.keep_last, self.max_age, self.max_bytes))
+
+    def mark(self, group_id):
+        if self.keep_last is not None:
+            self.dirty_groups.add(group_id)
+
+    async def start(self):
+        if self.enabled:
+            self.task = asyncio.ensure_future(self.run_loop())
+            self.logger.info(f"Retention enabled (keep_last={self.keep_last}, max_age={self.max_age}, "
+                             f"max_bytes={self.max_bytes}, every {self.interval}s)")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run_loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.logger.error(f"Error enforcing retention: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        deleted, freed = 0, 0
+        if self.keep_last is not None:
+            d, f = await self.trim_groups()
+            deleted, freed = deleted + d, freed + f
+        if self.max_age is not None:
+            d, f = await self.delete_windows(expired_before=int(time.time()) - self.max_age)
+            deleted, freed = deleted + d, freed + f
+        if self.max_bytes is not None:
+            d, f = await self.enforce_byte_budget()
+            deleted, freed = deleted + d, freed + f
+
+        reclaimed = 0
+        if deleted:
+            while True:
+                pass_reclaimed = await self.db_manager.incremental_vacuum(self.vacuum_pages)
+                if not pass_reclaimed:
+                    break
+                reclaimed += pass_reclaimed
+                await asyncio.sleep(BATCH_PAUSE)
+
+        self.stats['runs'] += 1
+        self.stats['messages_deleted'] += deleted
+        self.stats['blob_bytes_freed'] += freed
+        self.stats['file_bytes_reclaimed'] += reclaimed
+        if deleted:
+            self.logger.info(f"Retention deleted {deleted} messages, freed {freed} bytes of content "
+                             f"and reclaimed {reclaimed} bytes of database file")
+        return deleted, freed, reclaimed
+
+    async def trim_groups(self):
+        if self.check_all_groups:
+            groups = await self.db_manager.groups_over(self.keep_last)
+            self.check_all_groups = False
+            self.dirty_groups.clear()
+        else:
+            groups, self.dirty_groups = self.dirty_groups, set()
+        deleted, freed = 0, 0
+        for group_id in groups:
+            while True:
+                d, f = await self.db_manager.trim_group(group_id, self.keep_last, self.batch_size)
+                deleted, freed = deleted + d, freed + f
+                if d < self.batch_size:
+                    break
+                await asyncio.sleep(BATCH_PAUSE)
+        return deleted, freed
+
+    async def delete_windows(self, expired_before=None, byte_target=None):
+        # Walks the table from the oldest message, one batch at a time, until byte_target bytes are freed.
+        # With byte_target, messages holding the blob of a group's newest message are kept, deleting them
+        # cannot free it. That set is looked up once per pass, outside the batches' write transactions;
+        # blobs that become newest during the pass are only deleted from when nothing references them
+        protected = await self.db_manager.latest_blob_hashes() if byte_target is not None else frozenset()
+        deleted, freed = 0, 0
+        after_id = 0
+        while after_id is not None:
+            d, f, after_id = await self.db_manager.delete_window(after_id, self.batch_size, expired_before,
+                                                                 protected)
+            deleted, freed = deleted + d, freed + f
+            if byte_target is not None and freed >= byte_target:
+                break
+            await asyncio.sleep(BATCH_PAUSE)
+        return deleted, freed
+
+    async def enforce_byte_budget(self):
+        # Blobs of the newest messages are never freed, so deleting history cannot make up for them
+        excess = await self.db_manager.reclaimable_blob_bytes() - self.max_bytes
+        if excess <= 0:
+            return 0, 0
+        return await self.delete_windows(byte_target=excess)
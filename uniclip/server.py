@@ -1,9 +1,84 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, conint
+from starlette.requests import ClientDisconnect
 from waitress import serve
 import uvicorn
+import asyncio
+import json
+import logging
+import os
 import sqlite3
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
 from datetime import datetime
+from .admission import BodyLimitMiddleware, RateLimiter, retry_after
+from .cache import LatestMessageCache, CachedMessage, EMPTY
+from .compression import COMPRESSION_THRESHOLD, DecompressionMiddleware, compress, negotiate
+from .delta import DELTA_THRESHOLD, apply_delta, make_delta, worth_sending
+from .blobs import BlobStore, content_digest
+from .database import DatabaseManager
+from .metrics import MetricsMiddleware, ServerMetrics
+from .retention import RetentionManager
+from .state import create_state
+from .uploads import TEXT_MIME_TYPE, UploadError, UploadManager
+from .writer import WriteBehindQueue
+
+# Upper bound on how long a single long-poll request may be held open
+MAX_POLL_WAIT = 60
+# Interval between keep-alive comments on idle event streams
+STREAM_KEEPALIVE = 15
+# Number of computed (base, target) deltas kept for reuse across pollers
+DELTA_CACHE_SIZE = 256
+# Largest page served by the history and search endpoints
+MAX_PAGE_SIZE = 200
+# Most groups a single batch poll may follow
+MAX_BATCH_GROUPS = 100
+# Worker processes read the server configuration from this environment variable
+CONFIG_ENV = 'UNICLIP_SERVER_CONFIG'
+
+@dataclass
+class ServerConfig:
+    host: str = '0.0.0.0'
+    port: int = 2547
+    # Worker processes; more than one shares state through the database
+    workers: int = 1
+    # memory or sqlite, see uniclip.state (default: memory for one worker, sqlite for more)
+    state_backend: Optional[str] = None
+    # Clients that have not registered, polled or sent an update for this many seconds are dropped
+    presence_ttl: int = 120
+    db_name: str = 'uniclip.db'
+    # Payloads of at least blob_file_threshold bytes are stored as files in blob_dir (None keeps them in SQLite)
+    blob_dir: str = 'uniclip-blobs'
+    blob_file_threshold: Optional[int] = 262144
+    # Number of groups whose latest message is kept in memory, and roughly how many bytes of content
+    # and compressed poll bodies they may hold
+    cache_size: int = 10000
+    cache_max_bytes: Optional[int] = 268435456
+    # sync, group or memory, see uniclip.writer
+    durability: str = 'group'
+    flush_interval_ms: int = 50
+    flush_max_rows: int = 500
+    # Poll responses and stored payloads at least this large are compressed
+    compression_threshold: int = COMPRESSION_THRESHOLD
+    # Retention limits, see uniclip.retention (None disables a limit)
+    retention_keep_last: Optional[int] = None
+    retention_max_age: Optional[int] = None
+    retention_max_bytes: Optional[int] = None
+    retention_interval: int = 60
+    # Largest chunked upload accepted, see uniclip.uploads (None for no limit)
+    max_upload_size: Optional[int] = 1073741824
+    # Largest request body accepted, after decompression; upload chunks are only limited by max_upload_size
+    max_request_size: Optional[int] = 16777216
+    # Updates and new uploads per second, with bursts of up to the given size, per client and per group (None disables)
+    client_rate: Optional[float] = 5
+    client_burst: int = 20
+    group_rate: Optional[float] = 20
+    group_burst: int = 60
+    # Updates are refused with 503 while this many messages wait to be committed (None disables)
+    write_queue_limit: Optional[int] = 1000
 
 class RegisterData(BaseModel):
     group_id: str
@@ -12,51 +87,66 @@ class RegisterData(BaseModel):
 class UpdateData(BaseModel):
     group_id: str
     client_id: str
-    content: str
+    content: Optional[str] = None
     timestamp: int
+    # Delta mode: ops (see uniclip.delta) against the group content with hash base_hash,
+    # producing content with the given hash, which is required
+    delta: Optional[list] = None
+    base_hash: Optional[str] = None
+    hash: Optional[str] = None
 
-class DatabaseManager:
-    def __init__(self, db_name='uniclip.db'):
-        self.db_name = db_name
-        self.conn = None
-        self.cursor = None
-
-    def init_db(self):
-        self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id TEXT,
-                content TEXT,
-                client_id TEXT,
-                timestamp INTEGER
-            )
-        ''')
-        self.conn.commit()
-
-    def record_message(self, group_id, content, client_id, timestamp):
-        self.cursor.execute('''
-            INSERT INTO messages (group_id, content, client_id, timestamp)
-            VALUES (?, ?, ?, ?)
-        ''', (group_id, content, client_id, timestamp))
-        self.conn.commit()
-
-    def get_latest_message(self, group_id):
-        self.cursor.execute('''
-            SELECT * FROM messages
-            WHERE group_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 1
-        ''', (group_id,))
-        return self.cursor.fetchone()
+class BatchPollData(BaseModel):
+    client_id: str
+    # group_id -> seq of the last message the client has seen in it (0 for none)
+    cursors: Dict[str, int]
+    # group_id -> SHA-256 of the client's content for that group, not resent if it matches
+    hashes: Dict[str, str] = {}
+    wait: float = 0
+
+class UploadData(BaseModel):
+    group_id: str
+    client_id: str
+    size: conint(ge=0)
+    # SHA-256 of the whole content in lowercase hex, checked when the upload completes
+    hash: str
+    mime_type: str = 'application/octet-stream'
+
+class CompleteUploadData(BaseModel):
+    timestamp: int
 
 class Server:
-    def __init__(self, logger):
+    def __init__(self, logger, config=None):
         self.logger = logger
-        self.db_manager = DatabaseManager()
-        self.clients = {}
-        self.app = FastAPI()
+        self.config = config or ServerConfig()
+        blob_store = BlobStore(self.config.blob_dir, self.config.blob_file_threshold, self.config.compression_threshold)
+        self.db_manager = DatabaseManager(logger, self.config.db_name, blob_store)
+        self.metrics = ServerMetrics()
+        self.db_manager.timer = self.metrics.db_seconds
+        self.writer = WriteBehindQueue(self.db_manager, logger, self.config.durability,
+                                       self.config.flush_interval_ms, self.config.flush_max_rows)
+        self.uploads = UploadManager(os.path.join(self.config.blob_dir, 'uploads'), logger, self.config.max_upload_size)
+        self.retention = RetentionManager(self.db_manager, logger, self.config.retention_keep_last,
+                                          self.config.retention_max_age, self.config.retention_max_bytes,
+                                          self.config.retention_interval)
+        state_backend = self.config.state_backend or ('sqlite' if self.config.workers > 1 else 'memory')
+        if state_backend != 'memory' and self.config.durability == 'memory':
+            raise ValueError("durability 'memory' keeps messages in one process and cannot be used with a shared state backend")
+        self.state = create_state(state_backend, self.db_manager, logger, self.config.presence_ttl)
+        self.notifier = self.state.notifier
+        # In memory-only mode the cache is the only copy of each group's latest message, so never evict
+        if self.config.durability == 'memory':
+            self.latest_cache = LatestMessageCache(None)
+        else:
+            self.latest_cache = LatestMessageCache(self.config.cache_size, self.config.cache_max_bytes)
+        self.delta_cache = OrderedDict()
+        self.client_limiter = RateLimiter(self.config.client_rate, self.config.client_burst) if self.config.client_rate else None
+        self.group_limiter = RateLimiter(self.config.group_rate, self.config.group_burst) if self.config.group_rate else None
+        self.app = FastAPI(lifespan=self.lifespan)
+        self.app.add_middleware(DecompressionMiddleware, max_size=self.config.max_request_size)
+        # Outside decompression, so oversized bodies are refused by their Content-Length before being read
+        self.app.add_middleware(BodyLimitMiddleware, max_size=self.config.max_request_size,
+                                unlimited=[('PUT', '/uploads/')])
+        self.app.add_middleware(MetricsMiddleware, metrics=self.metrics, routes=self.app.routes)
         self.setup_routes()
         self.logger.info("Server initialized")
 
@@ -64,59 +154,531 @@ class Server:
         self.app.post("/register")(self.handle_register)
         self.app.post("/update")(self.handle_update)
         self.app.get("/poll/{group_id}/{client_id}")(self.handle_poll)
+        self.app.post("/poll")(self.handle_batch_poll)
+        self.app.get("/stream/{group_id}/{client_id}")(self.handle_stream)
+        self.app.get("/history/{group_id}")(self.handle_history)
+        self.app.get("/history/{group_id}/{message_id}")(self.handle_history_message)
+        self.app.get("/search/{group_id}")(self.handle_search)
+        self.app.post("/uploads")(self.handle_create_upload)
+        self.app.get("/uploads/{upload_id}")(self.handle_upload_status)
+        self.app.put("/uploads/{upload_id}")(self.handle_upload_chunk)
+        self.app.post("/uploads/{upload_id}/complete")(self.handle_complete_upload)
+        self.app.get("/blobs/{group_id}/{hash}")(self.handle_blob)
+        self.app.get("/members/{group_id}")(self.handle_members)
+        self.app.get("/metrics")(self.handle_metrics)
         self.logger.info("Routes set up")
 
     def run(self):
-        self.logger.info("Running server on port 2547")
+        host, port, workers = self.config.host, self.config.port, self.config.workers
+        self.logger.info(f"Running server on {host}:{port} with {workers} worker(s)")
         self.db_manager.init_db()
         self.logger.info("Database initialized")
-        uvicorn.run(self.app, host="0.0.0.0", port=2547)
+        if workers > 1:
+            # Each worker process builds its own Server from the same configuration
+            self.db_manager.close()
+            os.environ[CONFIG_ENV] = json.dumps(asdict(self.config))
+            uvicorn.run("uniclip.server:create_worker_app", factory=True, host=host, port=port, workers=workers)
+        else:
+            uvicorn.run(self.app, host=host, port=port)
+
+    @asynccontextmanager
+    async def lifespan(self, app):
+        # Startup and shutdown event handlers are gone from current Starlette releases
+        await self.startup()
+        try:
+            yield
+        finally:
+            await self.shutdown()
+
+    async def startup(self):
+        await self.writer.start()
+        await self.retention.start()
+        await self.uploads.start()
+        await self.state.start(self.on_message)
+
+    async def shutdown(self):
+        await self.state.stop()
+        await self.uploads.stop()
+        await self.retention.stop()
+        await self.writer.stop()
+        self.db_manager.close()
+        self.logger.info("Database closed")
 
     async def handle_register(self, data: RegisterData):
         group_id = data.group_id
         client_id = data.client_id
         self.logger.debug(f"Received registration request for group: {group_id}, client: {client_id}")
-        if group_id not in self.clients:
-            self.clients[group_id] = []
-            self.logger.debug(f"Created new group: {group_id}")
-        self.clients[group_id].append(client_id)
+        await self.state.register(group_id, client_id)
         self.logger.info(f"Client registered: {client_id} in group {group_id}")
-        self.logger.debug(f"Current clients in group {group_id}: {self.clients[group_id]}")
+        self.logger.debug(f"Current clients in group {group_id}: {list(await self.state.members(group_id))}")
         return {"status": "registered"}
 
     async def handle_update(self, data: UpdateData):
         group_id = data.group_id
         client_id = data.client_id
-        content = data.content
         timestamp = data.timestamp
-        
         self.logger.debug(f"Received update request from {client_id} for group: {group_id}")
-        self.db_manager.record_message(group_id, content, client_id, timestamp)
+        self.admit(group_id, client_id)
+        await self.state.touch(group_id, client_id)
+
+        if data.delta is not None:
+            if not data.hash:
+                raise HTTPException(status_code=422, detail="A delta update needs the hash of its result")
+            content = await self.resolve_delta(data)
+        elif data.content is not None:
+            content = data.content
+        else:
+            raise HTTPException(status_code=422, detail="Either content or delta is required")
+        payload = content.encode('utf-8')
+        digest = content_digest(payload)
+        if data.delta is not None and data.hash != digest:
+            raise HTTPException(status_code=409, detail="Delta result does not match hash, send the full content")
+
+        seq = await self.state.next_seq(group_id)
+        await self.writer.put(group_id, content, client_id, timestamp, digest, seq)
+        self.latest_cache.update(group_id, content, timestamp, client_id, digest, seq)
+        self.state.publish(group_id)
+        self.retention.mark(group_id)
+        self.metrics.update_bytes.inc(amount=len(payload))
         self.logger.info(f"Message received from {client_id} in group {group_id}")
         self.logger.debug(f"Message content: {content[:50]}... Timestamp: {timestamp}")
         
-        return {"status": "updated"}
+        return {"status": "updated", "seq": seq}
+
+    def admit(self, group_id, client_id):
+        # Refuses a new message with 503 while the write queue is backed up, or 429 when its client
+        # or group is over its rate. Refusals are only logged at debug level, a flood would fill the log
+        limit = self.config.write_queue_limit
+        if limit is not None and self.writer.depth >= limit:
+            self.metrics.rejected.inc('backpressure')
+            self.logger.debug(f"Refusing update from {client_id} in group {group_id}: {self.writer.depth} messages waiting to be committed")
+            raise HTTPException(status_code=503, detail="Server is busy, retry later", headers={"Retry-After": retry_after(1)})
+        for reason, limiter, key in (('client_rate', self.client_limiter, (group_id, client_id)),
+                                     ('group_rate', self.group_limiter, group_id)):
+            if limiter is None:
+                continue
+            wait = limiter.acquire(key)
+            if wait:
+                self.metrics.rejected.inc(reason)
+                self.logger.debug(f"Refusing update from {client_id} in group {group_id}: over {reason}, retry in {wait:.2f}s")
+                raise HTTPException(status_code=429, detail="Too many updates, retry later",
+                                    headers={"Retry-After": retry_after(wait)})
+
+    @staticmethod
+    def upload_error(e):
+        body = {"detail": str(e)}
+        if e.offset is not None:
+            # Where the client should continue from
+            body["offset"] = e.offset
+        return JSONResponse(body, status_code=e.status)
+
+    # Chunked uploads for large or non-text contents: create the upload, PUT the raw bytes in
+    # one or more requests at ?offset=, then complete it to make it the group's latest message
+    async def handle_create_upload(self, data: UploadData):
+        self.admit(data.group_id, data.client_id)
+        await self.state.touch(data.group_id, data.client_id)
+        try:
+            upload = await self.uploads.create(data.group_id, data.client_id, data.size, data.hash, data.mime_type)
+        except UploadError as e:
+            return self.upload_error(e)
+        return upload
+
+    async def handle_upload_status(self, upload_id: str):
+        try:
+            return await self.uploads.status(upload_id)
+        except UploadError as e:
+            return self.upload_error(e)
+
+    async def handle_upload_chunk(self, request: Request, upload_id: str, offset: int = Query(..., ge=0)):
+        try:
+            received = await self.uploads.write(upload_id, offset, request.stream())
+        except UploadError as e:
+            return self.upload_error(e)
+        except ClientDisconnect:
+            self.logger.info(f"Client disconnected while sending a chunk of upload {upload_id}")
+            return Response(status_code=400)
+        self.metrics.upload_bytes.inc(amount=received - offset)
+        self.logger.debug(f"Upload {upload_id} received bytes {offset}-{received}")
+        return {"upload_id": upload_id, "offset": received}
+
+    async def handle_complete_upload(self, upload_id: str, data: CompleteUploadData):
+        try:
+            async with self.uploads.lock(upload_id):
+                upload, part_path = await self.uploads.finish(upload_id)
+                group_id, client_id, digest = upload["group_id"], upload["client_id"], upload["hash"]
+                seq = await self.state.next_seq(group_id)
+                await self.db_manager.record_file_message(group_id, client_id, data.timestamp, part_path, digest,
+                                                          upload["size"], upload["mime_type"], seq)
+                await self.uploads.remove(upload_id)
+        except UploadError as e:
+            return self.upload_error(e)
+        # Uploaded messages bypass the write-behind queue, the file is already on disk
+        self.latest_cache.update(group_id, None, data.timestamp, client_id, digest, seq, upload["mime_type"], upload["size"])
+        self.state.publish(group_id)
+        self.retention.mark(group_id)
+        self.metrics.update_bytes.inc(amount=upload["size"])
+        self.logger.info(f"Upload of {upload['size']} bytes ({upload['mime_type']}) received from {client_id} in group {group_id}")
+        return {"status": "updated", "hash": digest, "seq": seq}
+
+    @staticmethod
+    def parse_range(header, size):
+        # (start, stop) of a single bytes range, or None to send everything
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, _, last = header[len('bytes='):].strip().partition('-')
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+            else:
+                start, stop = max(size - int(last), 0), size
+        except ValueError:
+            return None
+        if start >= size or stop <= start:
+            raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+        return start, min(stop, size)
+
+    # Contents of a message in the group by hash; supports single Range requests so
+    # interrupted downloads can be resumed
+    async def handle_blob(self, request: Request, group_id: str, hash: str):
+        blob = await self.db_manager.get_blob(group_id, hash)
+        if blob is None:
+            raise HTTPException(status_code=404, detail="Blob not found")
+        size, data, path, encoding, mime_type = blob
+        byte_range = self.parse_range(request.headers.get('range'), size)
+        start, stop = byte_range or (0, size)
+        headers = {"Accept-Ranges": "bytes", "ETag": f'"{hash}"', "Content-Length": str(stop - start)}
+        status_code = 200
+        if byte_range is not None:
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        media_type = mime_type or TEXT_MIME_TYPE
+        self.metrics.blob_bytes.inc(amount=stop - start)
+        blob_store = self.db_manager.blob_store
+        if path is not None and encoding is None:
+            # Streamed from the file in chunks, memory use does not depend on the blob size
+            return StreamingResponse(blob_store.iter_file(path, start, stop), status_code=status_code,
+                                     media_type=media_type, headers=headers)
+        loop = asyncio.get_event_loop()
+        payload = await loop.run_in_executor(None, blob_store.read, data, path, encoding)
+        return Response(payload[start:stop], status_code=status_code, media_type=media_type, headers=headers)
+
+    def on_message(self, group_id, seq, digest):
+        # A message committed by one of the server processes sharing the database
+        cached = self.latest_cache.peek(group_id)
+        if isinstance(cached, CachedMessage) and cached.seq is not None and cached.seq >= seq:
+            return
+        self.logger.debug(f"New message in group {group_id} from another server process")
+        self.latest_cache.invalidate(group_id)
+        self.notifier.notify(group_id)
+
+    async def resolve_delta(self, data):
+        base = await self.get_content(data.group_id, data.base_hash) if data.base_hash else None
+        if base is None:
+            self.logger.debug(f"Delta base {data.base_hash} not found for group {data.group_id}")
+            raise HTTPException(status_code=409, detail="Delta base not found, send the full content")
+        try:
+            return apply_delta(base, data.delta)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=422, detail=f"Invalid delta: {e}")
+
+    async def get_content(self, group_id, digest):
+        latest = self.latest_cache.peek(group_id)
+        if isinstance(latest, CachedMessage) and latest.digest == digest:
+            return latest.content
+        content = self.writer.find_content(group_id, digest)
+        if content is not None:
+            return content
+        return await self.db_manager.get_content(group_id, digest)
+
+    async def delta_update(self, group_id, update, base_hash):
+        # Turns an update_needed response into an update_delta against base_hash when that is smaller
+        content = update.get('content')
+        if content is None or len(content) < DELTA_THRESHOLD or base_hash == update['hash']:
+            return None
+        key = (base_hash, update['hash'])
+        ops = self.delta_cache.get(key)
+        if ops is None:
+            base = await self.get_content(group_id, base_hash)
+            if base is None:
+                return None
+            loop = asyncio.get_event_loop()
+            ops = await loop.run_in_executor(None, make_delta, base, content)
+            self.delta_cache[key] = ops
+            while len(self.delta_cache) > DELTA_CACHE_SIZE:
+                self.delta_cache.popitem(last=False)
+        if not worth_sending(ops, content):
+            return None
+        return {"status": "update_delta", "delta": ops, "base_hash": base_hash,
+                "timestamp": update['timestamp'], "hash": update['hash'], "seq": update['seq']}
 
-    async def handle_poll(self, group_id: str, client_id: str, hash: str = Query(...), timestamp: int = Query(...)):
+    async def get_latest(self, group_id):
+        entry = self.latest_cache.get(group_id)
+        if entry is None:
+            self.logger.debug(f"Latest message cache miss for group {group_id}")
+            # An entry evicted before the write-behind queue committed it is still buffered there.
+            # Look before querying: rows leave the queue only once committed, so the query sees it then
+            pending = self.writer.latest_row(group_id)
+            latest_message = await self.db_manager.get_latest_message(group_id)
+            if latest_message:
+                _, _, content, client_id, timestamp, digest, mime_type, size, seq = latest_message
+                entry = CachedMessage(content, timestamp, client_id, digest, {}, mime_type, size, seq)
+            else:
+                entry = EMPTY
+            if pending is not None and (entry is EMPTY or entry.seq is None or pending[5] > entry.seq):
+                group_id, content, client_id, timestamp, digest, seq = pending
+                entry = CachedMessage(content, timestamp, client_id, digest, {}, None, None, seq)
+            entry = self.latest_cache.fill(group_id, entry)
+        return None if entry is EMPTY else entry
+
+    async def check_for_update(self, group_id, timestamp=0, client_hash=None, since=None):
+        # since is the seq of the last message the client has seen in the group; clients
+        # that don't send it get messages with a newer timestamp than theirs
+        latest = await self.get_latest(group_id)
+        if latest is None:
+            return None
+        if since is not None and latest.seq is not None:
+            if latest.seq <= since:
+                return None
+        elif latest.timestamp <= timestamp:
+            return None
+        if client_hash == latest.digest:
+            # The client already holds this content, only move its cursor forward
+            return {"status": "not_modified", "timestamp": latest.timestamp, "hash": latest.digest, "seq": latest.seq}
+        if latest.mime_type is not None:
+            # Uploaded contents are fetched separately from /blobs/{group_id}/{hash}
+            return {"status": "update_needed", "timestamp": latest.timestamp, "hash": latest.digest,
+                    "mime_type": latest.mime_type, "size": latest.size, "seq": latest.seq}
+        return {"status": "update_needed", "content": latest.content, "timestamp": latest.timestamp,
+                "hash": latest.digest, "seq": latest.seq}
+
+    async def encode_update(self, group_id, update, encoding):
+        # Compress an update_needed body once per message and encoding, then reuse it for every poller
+        entry = self.latest_cache.peek(group_id)
+        encoded = entry.encoded if isinstance(entry, CachedMessage) and entry.digest == update['hash'] else {}
+        body = encoded.get(encoding)
+        if body is None:
+            loop = asyncio.get_event_loop()
+            body = encoded[encoding] = loop.run_in_executor(None, compress, json.dumps(update).encode(), encoding)
+            result = await body
+            self.latest_cache.charge(group_id, update['hash'], len(result))
+            return result
+        return await body
+
+    @staticmethod
+    def parse_etag(header):
+        if not header:
+            return None
+        etag = header.split(',')[0].strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        return etag.strip('"')
+
+    # since is the seq of the last message the client has seen; older clients send timestamp instead
+    # hash (or If-None-Match) is the SHA-256 of the client's clipboard; matching content is not resent
+    # wait > 0 holds the request open until the group gets a new message or the wait expires
+    # delta asks for large updates as a delta against the content with that hash
+    async def handle_poll(self, request: Request, response: Response, group_id: str, client_id: str,
+                          hash: Optional[str] = Query(None), timestamp: int = Query(0), since: Optional[int] = Query(None),
+                          wait: float = Query(0, ge=0), delta: bool = Query(False)):
         self.logger.debug(f"Received poll request from {client_id} for group: {group_id}")
-        
-        latest_message = self.db_manager.get_latest_message(group_id)
-        
-        if latest_message:
-            _, _, content, _, server_timestamp = latest_message
-            if server_timestamp > timestamp:
-                self.logger.info(f"Sending update to client {client_id} in group {group_id}")
-                self.logger.debug(f"Update content: {content[:50]}... Timestamp: {server_timestamp}")
-                return {"status": "update_needed", "content": content, "timestamp": server_timestamp}
-        
+        await self.state.touch(group_id, client_id)
+        wait = min(wait, MAX_POLL_WAIT)
+        if_none_match = self.parse_etag(request.headers.get('if-none-match'))
+        client_hash = hash or if_none_match
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + wait
+        while True:
+            with self.notifier.watch([group_id] if wait > 0 else []) as events:
+                update = await self.check_for_update(group_id, timestamp, client_hash, since)
+                remaining = deadline - loop.time()
+                if update is not None or remaining <= 0:
+                    break
+                self.logger.debug(f"Holding poll from {client_id} in group {group_id} for up to {remaining:.1f}s")
+                if not await self.notifier.wait(events[0], remaining):
+                    break
+
+        status = update['status'] if update is not None else 'no_update'
+        if update is not None and update['status'] == 'not_modified':
+            self.metrics.poll_results.inc('poll', status)
+            self.logger.debug(f"Client {client_id} in group {group_id} already has the latest content")
+            headers = {"ETag": f'"{update["hash"]}"', "X-Uniclip-Timestamp": str(update['timestamp']),
+                       "X-Uniclip-Seq": str(update['seq'])}
+            if if_none_match:
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+            return update
+
+        if update is not None and delta and client_hash:
+            delta_update = await self.delta_update(group_id, update, client_hash)
+            if delta_update is not None:
+                self.metrics.poll_results.inc('poll', delta_update['status'])
+                self.logger.info(f"Sending delta update to client {client_id} in group {group_id}")
+                response.headers["ETag"] = f'"{update["hash"]}"'
+                return delta_update
+
+        self.metrics.poll_results.inc('poll', status)
+        if update is not None:
+            self.logger.info(f"Sending update to client {client_id} in group {group_id}")
+            content = update.get('content', '')
+            self.logger.debug(f"Update content: {content[:50]}... Timestamp: {update['timestamp']}")
+            headers = {"ETag": f'"{update["hash"]}"', "Vary": "Accept-Encoding"}
+            encoding = None
+            if len(content) >= self.config.compression_threshold:
+                encoding = negotiate(request.headers.get('accept-encoding'))
+            if encoding is not None:
+                body = await self.encode_update(group_id, update, encoding)
+                self.logger.debug(f"Sending {encoding} compressed update ({len(body)} bytes)")
+                headers["Content-Encoding"] = encoding
+                self.metrics.sent_bytes.inc(encoding, amount=len(body))
+                return Response(body, media_type="application/json", headers=headers)
+            response.headers.update(headers)
+            self.metrics.sent_bytes.inc('identity', amount=len(content.encode('utf-8')))
+            return update
+
         self.logger.debug(f"No update needed for client {client_id} in group {group_id}")
         return {"status": "no_update"}
 
-def create_server(logger):
-    return Server(logger)
+    # Server-sent events: one "update" event per new message, keep-alive comments while idle
+    async def handle_stream(self, request: Request, group_id: str, client_id: str, timestamp: int = Query(0),
+                            since: Optional[int] = Query(None), hash: Optional[str] = Query(None),
+                            delta: bool = Query(False)):
+        self.logger.info(f"Client {client_id} opened an event stream for group {group_id}")
+
+        async def events():
+            last_timestamp = timestamp
+            last_seq = since
+            last_hash = hash
+            try:
+                while not await request.is_disconnected():
+                    # Runs at least every keep-alive interval, keeping the client present
+                    await self.state.touch(group_id, client_id)
+                    with self.notifier.watch([group_id]) as events:
+                        update = await self.check_for_update(group_id, last_timestamp, last_hash, last_seq)
+                        woken = update is not None or await self.notifier.wait(events[0], STREAM_KEEPALIVE)
+                    if update is not None:
+                        if delta and last_hash and update['status'] == 'update_needed':
+                            update = await self.delta_update(group_id, update, last_hash) or update
+                        last_timestamp = update['timestamp']
+                        # From the first event on, the stream follows seq even if the client didn't send one
+                        last_seq = update['seq']
+                        last_hash = update['hash']
+                        self.metrics.poll_results.inc('stream', update['status'])
+                        self.logger.debug(f"Streaming {update['status']} to client {client_id} in group {group_id}")
+                        yield f"event: {update['status']}\ndata: {json.dumps(update)}\n\n"
+                    elif not woken:
+                        yield ": keepalive\n\n"
+            finally:
+                self.logger.info(f"Event stream closed for client {client_id} in group {group_id}")
+
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # One long-poll for several groups: answers with the updates of every group whose latest
+    # message is past the client's cursor, as soon as there is at least one
+    async def handle_batch_poll(self, request: Request, data: BatchPollData):
+        if not data.cursors:
+            raise HTTPException(status_code=422, detail="cursors must name at least one group")
+        if len(data.cursors) > MAX_BATCH_GROUPS:
+            raise HTTPException(status_code=422, detail=f"A batch poll follows at most {MAX_BATCH_GROUPS} groups")
+        for group_id in data.cursors:
+            await self.state.touch(group_id, data.client_id)
+        self.logger.debug(f"Received batch poll from {data.client_id} for {len(data.cursors)} groups")
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + min(max(data.wait, 0), MAX_POLL_WAIT)
+        while True:
+            with self.notifier.watch(list(data.cursors) if data.wait > 0 else []) as events:
+                updates = {}
+                for group_id, cursor in data.cursors.items():
+                    update = await self.check_for_update(group_id, client_hash=data.hashes.get(group_id), since=cursor)
+                    if update is not None:
+                        updates[group_id] = update
+                remaining = deadline - loop.time()
+                if updates or remaining <= 0:
+                    break
+                if not await self.notifier.wait_any(events, remaining):
+                    break
+
+        for update in updates.values():
+            self.metrics.poll_results.inc('batch', update['status'])
+        if not updates:
+            self.metrics.poll_results.inc('batch', 'no_update')
+        else:
+            self.logger.info(f"Sending updates for {len(updates)} groups to client {data.client_id}")
+        body = json.dumps({"updates": updates}).encode()
+        headers = {"Vary": "Accept-Encoding"}
+        encoding = None
+        if len(body) >= self.config.compression_threshold:
+            encoding = negotiate(request.headers.get('accept-encoding'))
+        if encoding is not None:
+            body = await loop.run_in_executor(None, compress, body, encoding)
+            headers["Content-Encoding"] = encoding
+        self.metrics.sent_bytes.inc(encoding or 'identity', amount=len(body))
+        return Response(body, media_type="application/json", headers=headers)
+
+    async def handle_members(self, group_id: str):
+        members = await self.state.members(group_id)
+        entries = [{"client_id": client_id, "registered_at": registered_at, "last_seen": last_seen}
+                   for client_id, (registered_at, last_seen) in members.items()]
+        entries.sort(key=lambda entry: entry["last_seen"], reverse=True)
+        return {"group_id": group_id, "members": entries}
+
+    async def handle_metrics(self):
+        groups, clients = await self.state.counts()
+        self.metrics.groups.set(groups)
+        self.metrics.clients.set(clients)
+        self.metrics.cached_groups.set(len(self.latest_cache))
+        self.metrics.cache_lookups.set(self.latest_cache.hits, 'hit')
+        self.metrics.cache_lookups.set(self.latest_cache.misses, 'miss')
+        self.metrics.waiting_groups.set(len(self.notifier.events))
+        self.metrics.writer_depth.set(self.writer.depth)
+        for kind in ('messages_deleted', 'blob_bytes_freed', 'file_bytes_reclaimed'):
+            self.metrics.retention.set(self.retention.stats[kind], kind)
+        return Response(self.metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @staticmethod
+    def history_page(messages, limit):
+        # Keyset pagination: pass next_before as before to get the following (older) page
+        next_before = messages[-1]["id"] if len(messages) == limit else None
+        return {"messages": messages, "next_before": next_before}
+
+    async def handle_history(self, group_id: str, before: Optional[int] = Query(None),
+                             limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), preview: int = Query(200, ge=0)):
+        self.logger.debug(f"History request for group {group_id} before {before}")
+        messages = await self.db_manager.get_history(group_id, before, limit, preview)
+        return self.history_page(messages, limit)
+
+    async def handle_history_message(self, group_id: str, message_id: int):
+        message = await self.db_manager.get_message(group_id, message_id)
+        if message is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        return message
+
+    async def handle_search(self, group_id: str, q: str = Query(..., min_length=1), before: Optional[int] = Query(None),
+                            limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), preview: int = Query(200, ge=0)):
+        if not self.db_manager.blob_store.fts_enabled:
+            raise HTTPException(status_code=501, detail="Search is unavailable, SQLite was built without FTS5")
+        self.logger.debug(f"Search request for group {group_id}: {q}")
+        try:
+            messages = await self.db_manager.search(group_id, q, before, limit, preview)
+        except sqlite3.OperationalError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+        return self.history_page(messages, limit)
+
+def create_server(logger, config=None):
+    return Server(logger, config)
+
+def create_worker_app():
+    # uvicorn application factory for multi-worker mode, see Server.run
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = Server(logging.getLogger('Uniclip'), ServerConfig(**json.loads(os.environ[CONFIG_ENV])))
+    server.db_manager.init_db()
+    return server.app
 
 if __name__ == "__main__":
-    import logging
     logger = logging.getLogger("uniclip")
     logger.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
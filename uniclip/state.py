@@ -0,0 +1,221 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# memory: membership and notifications live in this process, for a single worker
+# sqlite: shared through the server database, for several workers or nodes on the same file
+STATE_BACKENDS = ('memory', 'sqlite')
+
+class GroupNotifier:
+    """Wakes up pending polls and streams when a group receives a new message."""
+
+    def __init__(self):
+        self.events = {}
+        # group_id -> requests inside watch(); a group's event is dropped once none are left
+        self.watchers = {}
+
+    @contextmanager
+    def watch(self, group_ids):
+        # Events for group_ids. Enter before checking for updates so that a notification
+        # arriving in between is not lost, and only when the request is going to wait
+        events = []
+        for group_id in group_ids:
+            self.watchers[group_id] = self.watchers.get(group_id, 0) + 1
+            event = self.events.get(group_id)
+            if event is None:
+                event = self.events[group_id] = asyncio.Event()
+            events.append(event)
+        try:
+            yield events
+        finally:
+            for group_id in group_ids:
+                self.watchers[group_id] -= 1
+                if not self.watchers[group_id]:
+                    del self.watchers[group_id]
+                    self.events.pop(group_id, None)
+
+    def notify(self, group_id):
+        event = self.events.pop(group_id, None)
+        if event is not None:
+            event.set()
+
+    @staticmethod
+    async def wait(event, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @staticmethod
+    async def wait_any(events, timeout):
+        # Like wait, returning as soon as any of the events is set
+        waiters = [asyncio.ensure_future(event.wait()) for event in events]
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        return bool(done)
+
+class MemoryState:
+    """Group membership and new-message notification for a single server process.
+
+    Membership is presence based: registering, polling, streaming and
+    updating mark a client as seen, and clients not seen for presence_ttl
+    seconds are dropped. Messages are numbered per group by next_seq(),
+    continuing from the highest number in the database.
+    """
+
+    def __init__(self, db_manager, logger, presence_ttl=120):
+        self.db_manager = db_manager
+        self.logger = logger
+        self.presence_ttl = presence_ttl
+        self.notifier = GroupNotifier()
+        # group_id -> last seq handed out by this process
+        self.sequences = {}
+        # group_id -> {client_id: [registered_at, last_seen]}
+        self.groups = {}
+        self.tasks = []
+
+    async def start(self, on_message):
+        self.tasks.append(asyncio.ensure_future(self.evict_loop()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def register(self, group_id, client_id):
+        await self.touch(group_id, client_id)
+
+    async def touch(self, group_id, client_id):
+        now = int(time.time())
+        members = self.groups.setdefault(group_id, {})
+        presence = members.get(client_id)
+        if presence is None:
+            members[client_id] = [now, now]
+        else:
+            presence[1] = now
+
+    async def members(self, group_id):
+        # {client_id: (registered_at, last_seen)} of live clients
+        seen_since = int(time.time()) - self.presence_ttl
+        return {client_id: tuple(presence) for client_id, presence in self.groups.get(group_id, {}).items()
+                if presence[1] >= seen_since}
+
+    async def counts(self):
+        # (groups, clients) that are live
+        seen_since = int(time.time()) - self.presence_ttl
+        live = [sum(1 for presence in members.values() if presence[1] >= seen_since) for members in self.groups.values()]
+        return sum(1 for count in live if count), sum(live)
+
+    async def next_seq(self, group_id):
+        current = self.sequences.get(group_id)
+        if current is None:
+            stored = await self.db_manager.max_seq(group_id)
+            # Another update for the group may have seeded the counter while we waited
+            current = self.sequences.setdefault(group_id, stored)
+        self.sequences[group_id] = current + 1
+        return current + 1
+
+    def publish(self, group_id):
+        # Called after this process accepted a message for group_id
+        self.notifier.notify(group_id)
+
+    async def evict_loop(self):
+        # Sweeping a few times per TTL keeps stale clients around for at most 1.25 TTLs
+        while True:
+            await asyncio.sleep(self.presence_ttl / 4)
+            try:
+                evicted = await self.evict(int(time.time()) - self.presence_ttl)
+            except Exception as e:
+                self.logger.error(f"Error evicting stale clients: {e}")
+                continue
+            if evicted:
+                self.logger.info(f"Evicted {evicted} clients not seen for {self.presence_ttl}s")
+
+    async def evict(self, seen_before):
+        evicted = 0
+        for group_id in list(self.groups):
+            members = self.groups[group_id]
+            for client_id in [c for c, presence in members.items() if presence[1] < seen_before]:
+                del members[client_id]
+                evicted += 1
+            if not members:
+                del self.groups[group_id]
+        return evicted
+
+class SqliteState(MemoryState):
+    """Shares membership and new messages between processes through the server database.
+
+    Membership is stored in the members table; each process writes a
+    client's last_seen at most every presence_ttl / 4 seconds to keep polls
+    off the database. Every process tails the messages table every
+    poll_interval seconds and passes each new message, its own included, to
+    on_message(group_id, seq, digest) so it can drop stale cached state
+    and wake local pollers. Messages only become visible to other processes
+    once the write-behind queue has committed them, so 'memory' durability
+    cannot be shared. Message numbers are allocated in the sequences table
+    so that processes never hand out the same one.
+    """
+
+    def __init__(self, db_manager, logger, presence_ttl=120, poll_interval=0.05):
+        super().__init__(db_manager, logger, presence_ttl)
+        self.poll_interval = poll_interval
+        self.last_id = 0
+        # (group_id, client_id) -> when last_seen was last written by this process
+        self.written = {}
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        self.last_id = await self.db_manager.last_message_id()
+        self.tasks.append(asyncio.ensure_future(self.tail(on_message)))
+        self.logger.info(f"Sharing server state through the database (checking every {self.poll_interval * 1000:.0f}ms)")
+
+    async def tail(self, on_message):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                rows = await self.db_manager.messages_after(self.last_id)
+            except sqlite3.Error as e:
+                self.logger.error(f"Error reading new messages: {e}")
+                continue
+            for message_id, group_id, seq, digest in rows:
+                self.last_id = message_id
+                on_message(group_id, seq, digest)
+
+    async def register(self, group_id, client_id):
+        now = int(time.time())
+        self.written[(group_id, client_id)] = now
+        await self.db_manager.touch_member(group_id, client_id, now)
+
+    async def touch(self, group_id, client_id):
+        now = int(time.time())
+        key = (group_id, client_id)
+        if now - self.written.get(key, 0) < self.presence_ttl / 4:
+            return
+        self.written[key] = now
+        await self.db_manager.touch_member(group_id, client_id, now)
+
+    async def next_seq(self, group_id):
+        return await self.db_manager.next_seq(group_id)
+
+    async def members(self, group_id):
+        return await self.db_manager.get_members(group_id, int(time.time()) - self.presence_ttl)
+
+    async def counts(self):
+        return await self.db_manager.member_counts(int(time.time()) - self.presence_ttl)
+
+    async def evict(self, seen_before):
+        self.written = {key: written for key, written in self.written.items() if written >= seen_before}
+        return await self.db_manager.evict_members(seen_before)
+
+def create_state(backend, db_manager, logger, presence_ttl=120):
+    if backend == 'memory':
+        return MemoryState(db_manager, logger, presence_ttl)
+    if backend == 'sqlite':
+        return SqliteState(db_manager, logger, presence_ttl)
+    raise ValueError(f"Unknown state backend: {backend} (expected one of {', '.join(STATE_BACKENDS)})")
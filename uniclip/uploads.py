@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from collections import namedtuple
+
+# Contents at least this large, or that are not UTF-8 text, go through chunked uploads
+UPLOAD_THRESHOLD = 1048576
+# Size of the PUT requests a client sends, and of the reads the server streams from files
+CHUNK_SIZE = 1048576
+# Uploads not completed within this many seconds are deleted
+UPLOAD_TTL = 86400
+# MIME type of text sent as a chunked upload
+TEXT_MIME_TYPE = 'text/plain; charset=utf-8'
+
+# Clipboard file contents that are large or not UTF-8 text, read from path when sent
+FileContent = namedtuple('FileContent', ['path', 'size'])
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+# Hashes name the blob files, so only accept what content_digest produces
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+# (magic prefix, MIME type) for contents copied from common file formats
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+]
+
+def sniff_mime_type(prefix):
+    for magic, mime_type in MAGIC_NUMBERS:
+        if prefix.startswith(magic):
+            return mime_type
+    if prefix.startswith(b'RIFF') and prefix[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+def is_text(mime_type):
+    return mime_type is not None and mime_type.startswith('text/')
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; status is the HTTP status to answer with."""
+
+    def __init__(self, status, message, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+class UploadManager:
+    """Resumable chunked uploads, staged as files under upload_dir.
+
+    Each upload is a <id>.part file holding the bytes received so far and a
+    <id>.json file with its metadata, so an upload survives server restarts
+    and can be continued through any worker process. A chunk must start at
+    the current size of the part file; after a broken connection the client
+    asks for the offset and sends the rest from there. Request bodies are
+    written to disk as they arrive, so memory use does not grow with the
+    size of the upload. upload_dir should be on the same filesystem as the
+    blob store, which takes the part file over with a rename.
+    """
+
+    def __init__(self, upload_dir, logger, max_size=None, ttl=UPLOAD_TTL):
+        self.upload_dir = upload_dir
+        self.logger = logger
+        self.max_size = max_size
+        self.ttl = ttl
+        # Chunks and completion of the same upload run one at a time within a process
+        self.locks = {}
+        self.task = None
+
+    async def start(self):
+        await self.in_executor(os.makedirs, self.upload_dir, 0o700, True)
+        self.task = asyncio.ensure_future(self.expire_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    @staticmethod
+    async def in_executor(func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def paths(self, upload_id):
+        if not UPLOAD_ID.match(upload_id):
+            raise UploadError(404, "Upload not found")
+        base = os.path.join(self.upload_dir, upload_id)
+        return base + '.json', base + '.part'
+
+    async def create(self, group_id, client_id, size, digest, mime_type):
+        if not DIGEST.match(digest):
+            raise UploadError(422, "hash must be a lowercase hex SHA-256")
+        if self.max_size is not None and size > self.max_size:
+            raise UploadError(413, f"Uploads are limited to {self.max_size} bytes")
+        upload_id = uuid.uuid4().hex
+        meta = {"upload_id": upload_id, "group_id": group_id, "client_id": client_id, "size": size,
+                "hash": digest, "mime_type": mime_type, "created_at": int(time.time())}
+        await self.in_executor(self._create, meta)
+        self.logger.info(f"Upload {upload_id} of {size} bytes ({mime_type}) started by {client_id} in group {group_id}")
+        return dict(meta, offset=0)
+
+    def _create(self, meta):
+        meta_path, part_path = self.paths(meta["upload_id"])
+        open(part_path, 'wb').close()
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_dir, prefix='.upload-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    async def status(self, upload_id):
+        return await self.in_executor(self._status, upload_id)
+
+    def _status(self, upload_id):
+        meta_path, part_path = self.paths(upload_id)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            meta["offset"] = os.path.getsize(part_path)
+        except FileNotFoundError:
+            raise UploadError(404, "Upload not found")
+        return meta
+
+    def lock(self, upload_id):
+        return self.locks.setdefault(upload_id, asyncio.Lock())
+
+    async def write(self, upload_id, offset, chunks):
+        # Appends the async iterable of byte chunks at offset; returns the new offset
+        async with self.lock(upload_id):
+            meta = await self.status(upload_id)
+            if offset != meta["offset"]:
+                raise UploadError(409, f"Upload is at offset {meta['offset']}", meta["offset"])
+            _, part_path = self.paths(upload_id)
+            f = await self.in_executor(open, part_path, 'r+b')
+            try:
+                f.seek(offset)
+                received = offset
+                async for chunk in chunks:
+                    received += len(chunk)
+                    if received > meta["size"]:
+                        # Keep what was there before this request
+                        await self.in_executor(f.truncate, offset)
+                        raise UploadError(413, f"Upload is larger than the announced {meta['size']} bytes", offset)
+                    await self.in_executor(f.write, chunk)
+            finally:
+                await self.in_executor(f.close)
+            return received
+
+    async def finish(self, upload_id):
+        # Checks size and hash; returns (metadata, path of the part file for BlobStore.adopt).
+        # Hold lock(upload_id) until the part file has been adopted and the upload removed
+        meta = await self.status(upload_id)
+        if meta["offset"] != meta["size"]:
+            raise UploadError(409, f"Upload is incomplete ({meta['offset']} of {meta['size']} bytes)", meta["offset"])
+        _, part_path = self.paths(upload_id)
+        digest = await self.in_executor(file_digest, part_path)
+        if digest != meta["hash"]:
+            await self.remove(upload_id)
+            raise UploadError(422, "Uploaded content does not match its hash, start a new upload")
+        return meta, part_path
+
+    async def remove(self, upload_id):
+        self.locks.pop(upload_id, None)
+        await self.in_executor(self._remove, upload_id)
+
+    def _remove(self, upload_id):
+        for path in self.paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def expire_loop(self):
+        while True:
+            try:
+                expired = await self.in_executor(self.expire, time.time() - self.ttl)
+            except OSError as e:
+                self.logger.error(f"Error expiring uploads: {e}")
+            else:
+                if expired:
+                    self.logger.info(f"Deleted {expired} uploads not completed within {self.ttl}s")
+            await asyncio.sleep(min(self.ttl, 3600))
+
+    def expire(self, older_than):
+        # Uploads whose last chunk arrived before older_than
+        expired = 0
+        for name in os.listdir(self.upload_dir):
+            upload_id, extension = os.path.splitext(name)
+            if extension != '.json' or not UPLOAD_ID.match(upload_id):
+                continue
+            meta_path, part_path = self.paths(upload_id)
+            try:
+                modified = max(os.path.getmtime(meta_path), os.path.getmtime(part_path))
+            except FileNotFoundError:
+                modified = 0
+            if modified < older_than:
+                self._remove(upload_id)
+                self.locks.pop(upload_id, None)
+                expired += 1
+        return expired
@@ -0,0 +1,195 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+import pyperclip
+from .uploads import UPLOAD_THRESHOLD, FileContent
+
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVE_SELF = 0x800
+IN_DELETE_SELF = 0x400
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, 'inotify_init1') else None
+
+class ClipboardWatcher:
+    """Detects clipboard changes and hands them to on_change(content, timestamp).
+
+    run() is a coroutine that returns once stop() is called; exceptions it
+    cannot handle itself (such as a missing clipboard mechanism) propagate to
+    the caller. on_change is called on the event loop.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.running = True
+        self.wakeup = asyncio.Event()
+
+    async def run(self, on_change):
+        raise NotImplementedError
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def poke(self):
+        # Hint that clipboard activity is likely, e.g. after content arrived from the server
+        pass
+
+    async def sleep(self, timeout):
+        # Sleeps for timeout seconds, or less if woken up by stop() or poke()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+class FileWatcher(ClipboardWatcher):
+    """Reports the contents of the headless clipboard file whenever its mtime changes.
+
+    Files of at least UPLOAD_THRESHOLD bytes or that are not UTF-8 are
+    reported as a FileContent instead of being read into memory.
+    """
+
+    def __init__(self, path, logger):
+        super().__init__(logger)
+        self.path = path
+        self.last_modified = 0
+
+    def check(self, on_change):
+        try:
+            current_modified = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            self.logger.debug(f"Clipboard file not found. Creating: {self.path}")
+            open(self.path, 'a').close()
+            return
+        if current_modified != self.last_modified:
+            self.last_modified = current_modified
+            on_change(self.read(), int(current_modified))
+
+    def read(self):
+        size = os.path.getsize(self.path)
+        if size >= UPLOAD_THRESHOLD:
+            return FileContent(self.path, size)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except UnicodeDecodeError:
+            return FileContent(self.path, size)
+
+class PollingFileWatcher(FileWatcher):
+    def __init__(self, path, logger, interval=0.5):
+        super().__init__(path, logger)
+        self.interval = interval
+
+    async def run(self, on_change):
+        self.logger.debug(f"Polling clipboard file every {self.interval}s: {self.path}")
+        while self.running:
+            try:
+                self.check(on_change)
+            except Exception as e:
+                self.logger.error(f"Error monitoring clipboard file: {e}")
+            await self.sleep(self.interval)
+
+class InotifyFileWatcher(FileWatcher):
+    """Sleeps in the kernel until the clipboard file is written, replaced or removed."""
+
+    # IN_MODIFY is left out on purpose: it fires mid-write and would report partial content
+    MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+
+    libc = _load_libc()
+
+    @classmethod
+    def available(cls):
+        return cls.libc is not None
+
+    def add_watch(self, fd):
+        if not os.path.exists(self.path):
+            open(self.path, 'a').close()
+        if self.libc.inotify_add_watch(fd, os.fsencode(self.path), self.MASK) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {self.path}")
+
+    async def run(self, on_change):
+        fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.logger.debug(f"Watching clipboard file with inotify: {self.path}")
+        loop = asyncio.get_event_loop()
+        loop.add_reader(fd, self.wakeup.set)
+        try:
+            self.add_watch(fd)
+            self.check(on_change)
+            while self.running:
+                await self.sleep(None)
+                try:
+                    data = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+                rewatch = False
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                    offset += EVENT_HEADER.size + name_length
+                    # The watch goes away with the inode when the file is deleted or replaced
+                    rewatch = rewatch or bool(mask & IN_IGNORED)
+                if rewatch:
+                    self.add_watch(fd)
+                try:
+                    self.check(on_change)
+                except Exception as e:
+                    self.logger.error(f"Error reading clipboard file: {e}")
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+def create_file_watcher(path, logger):
+    if InotifyFileWatcher.available():
+        return InotifyFileWatcher(path, logger)
+    logger.info("inotify is unavailable, polling the clipboard file instead")
+    return PollingFileWatcher(path, logger)
+
+class AdaptiveClipboardWatcher(ClipboardWatcher):
+    """Polls the system clipboard, backing off while it is idle.
+
+    Each pyperclip.paste() forks xclip/xsel on Linux, so the interval grows
+    from min_interval to max_interval while nothing changes and drops back
+    to min_interval after a change or a call to poke().
+    """
+
+    def __init__(self, logger, min_interval=0.25, max_interval=3.0, backoff=1.5):
+        super().__init__(logger)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.last_content = None
+
+    def poke(self):
+        self.interval = self.min_interval
+        self.wakeup.set()
+
+    async def run(self, on_change):
+        self.logger.debug("Starting to monitor system clipboard")
+        loop = asyncio.get_event_loop()
+        while self.running:
+            # paste() forks a helper process, keep it off the event loop
+            content = await loop.run_in_executor(None, pyperclip.paste)
+            if content != self.last_content:
+                if self.last_content is not None or content:
+                    on_change(content, int(time.time()))
+                self.last_content = content
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            await self.sleep(self.interval)
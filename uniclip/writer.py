@@ -0,0 +1,106 @@
+import asyncio
+
+# sync:   every update is committed before /update returns
+# group:  updates are buffered and committed together every flush interval (or batch size)
+# memory: nothing is persisted, the latest message per group only lives in the server cache
+DURABILITY_MODES = ('sync', 'group', 'memory')
+
+class WriteBehindQueue:
+    """Buffers message rows and commits them to the database in batches."""
+
+    def __init__(self, db_manager, logger, durability='group', flush_interval_ms=50, flush_max_rows=500):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability} (expected one of {', '.join(DURABILITY_MODES)})")
+        self.db_manager = db_manager
+        self.logger = logger
+        self.durability = durability
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_rows = flush_max_rows
+        # Writers wait for a flush once a batch is buffered, so a crash loses at most one batch
+        self.max_pending = flush_max_rows
+        self.pending = []
+        # Updates inside a sync mode commit
+        self.writing = 0
+        self.wakeup = None
+        self.flush_lock = None
+        self.task = None
+
+    @property
+    def depth(self):
+        return len(self.pending) + self.writing
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        if self.durability == 'group':
+            self.task = asyncio.ensure_future(self.flush_loop())
+            self.logger.info(f"Write-behind queue started (flush every {self.flush_interval * 1000:.0f}ms or {self.flush_max_rows} rows)")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def put(self, group_id, content, client_id, timestamp, digest=None, seq=None):
+        row = (group_id, content, client_id, timestamp, digest, seq)
+        if self.durability == 'sync':
+            self.writing += 1
+            try:
+                await self.db_manager.record_messages([row])
+            finally:
+                self.writing -= 1
+        elif self.durability == 'group':
+            while len(self.pending) >= self.max_pending:
+                self.logger.warning(f"Write-behind queue is full ({len(self.pending)} rows), waiting for flush")
+                if not await self.flush():
+                    # The database is failing; keep the update rather than the bound
+                    break
+            self.pending.append(row)
+            if len(self.pending) >= self.flush_max_rows:
+                self.wakeup.set()
+
+    def find_content(self, group_id, digest):
+        # Content of a buffered, not yet committed message
+        for row in reversed(self.pending):
+            if row[0] == group_id and row[4] == digest:
+                return row[1]
+        return None
+
+    def latest_row(self, group_id):
+        # Newest buffered row of group_id, which the database cannot return yet
+        for row in reversed(self.pending):
+            if row[0] == group_id:
+                return row
+        return None
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        # Returns False if rows could not be committed and are still pending
+        if self.flush_lock is None:
+            return True
+        async with self.flush_lock:
+            while self.pending:
+                # Rows stay in pending until committed, so latest_row and find_content keep seeing them
+                batch = self.pending[:self.flush_max_rows]
+                try:
+                    await self.db_manager.record_messages(batch)
+                except Exception as e:
+                    # Keep the rows and retry on the next tick rather than dropping them
+                    self.logger.error(f"Error flushing {len(batch)} messages to database: {e}")
+                    return False
+                del self.pending[:len(batch)]
+                self.logger.debug(f"Flushed {len(batch)} messages to database")
+        return True